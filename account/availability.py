@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+
+from account.models import normalize_account, account_q
+
+logger = logging.getLogger(__name__)
+
+LOAD_BATCH = 1000 # users read per query when the filter is built
+MIN_CAPACITY = 10000
+ERROR_RATE = 0.01 # false positives, they only cost a query
+VERSION_KEY = 'accounts:version' # number of accounts appended to the shared log
+LOG_TIMEOUT = 24 * 3600 # seconds an entry of the log stays in the cache
+MAX_CATCH_UP = 1000 # entries a process reads from the log at once, further behind it rebuilds its filter
+
+
+class BloomFilter(object):
+    ''' Set of strings that may answer yes for a string never added (about error_rate of the time)
+        but never answers no for a string added.
+    '''
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2)) # bits
+        self.k = max(1, int(round(self.size / capacity * math.log(2)))) # bits set per string
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, s):
+        # k positions from two 64 bit hashes, h1 + i * h2
+        h = hashlib.blake2b(s.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], 'little')
+        h2 = int.from_bytes(h[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.k)]
+
+    def add(self, s):
+        for p in self.positions(s):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, s):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(s))
+
+
+def log_key(n):
+    return 'accounts:added:%s' % n
+
+def get_log_version():
+    return cache.get(VERSION_KEY, 0)
+
+def publish(key):
+    ''' Append an account to the log of accounts added, shared by the processes through the cache
+    '''
+    try:
+        n = cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 0, None)
+        n = cache.incr(VERSION_KEY)
+    cache.set(log_key(n), key, LOG_TIMEOUT)
+
+
+class AccountFilter(object):
+    ''' Bloom filter of the lower cased usernames and emails of the users.
+        Accounts saved by any process are appended to a log in the cache (a version counter and one
+        entry per account, like the orders version of commerce.feed), each process adds the entries
+        it hasn't seen before answering. When the log can't be followed (entries evicted, counter reset)
+        or the filter is older than ttl or full, it is rebuilt from User in a background thread, one at a
+        time, and the database answers until a filter is there. The first filter of a process is loaded
+        at its first check, a process forked from one loading it (gunicorn --preload) starts its own load.
+    '''
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.loaded = None
+        self.filter = None
+        self.version = 0 # last entry of the log in the filter
+        self.rebuilding = False
+        self.pid = os.getpid()
+
+    def check_fork(self):
+        # a forked process has a copy of the filter but not the thread loading it, and a copy of the lock
+        # that stays held if that thread had it at the fork
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+            self.rebuilding = False
+
+    def load(self):
+        User = get_user_model()
+        version = get_log_version() # accounts saved from now on are in the log after version
+        bloom = BloomFilter(max(MIN_CAPACITY, 4 * User.objects.count())) # two names a user, room to grow
+        users = User.objects.order_by('id').values_list('id', 'username', 'email')
+        last_id = 0
+        while True:
+            batch = list(users.filter(id__gt=last_id)[:LOAD_BATCH])
+            if not batch:
+                break
+            for _, username, email in batch:
+                for key in (normalize_account(username), normalize_account(email)):
+                    if key:
+                        bloom.add(key)
+            last_id = batch[-1][0]
+        with self.lock:
+            self.filter = bloom
+            self.version = version
+            self.loaded = time.time()
+
+    def rebuild(self):
+        ''' Load a new filter in a background thread unless one is loading, the current one answers meanwhile
+        '''
+        self.check_fork()
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target=self.run_rebuild, name='account-filter', daemon=True).start()
+
+    def run_rebuild(self):
+        try:
+            self.load()
+        except Exception as e:
+            logger.error('Load account filter exception:%s' % e)
+        finally:
+            with self.lock:
+                self.rebuilding = False
+            connection.close() # the thread has its own connection
+
+    def catch_up(self):
+        ''' Add the accounts of the log the filter doesn't have. Return True when it is up to date, None when
+            the last entries are not written yet, False when the log can't be followed
+        '''
+        version = get_log_version()
+        with self.lock:
+            if version == self.version:
+                return True
+            if version < self.version or version - self.version > MAX_CATCH_UP: # reset or too far behind
+                return False
+            start = self.version
+        entries = cache.get_many([log_key(n) for n in range(start + 1, version + 1)])
+        with self.lock:
+            for n in range(self.version + 1, version + 1):
+                key = entries.get(log_key(n))
+                if key is None: # evicted, or not written yet when no later entry is there
+                    return None if all(log_key(m) not in entries for m in range(n, version + 1)) else False
+                self.filter.add(key)
+                self.version = n
+        return True
+
+    def add(self, *accounts):
+        for key in filter(None, map(normalize_account, accounts)):
+            publish(key)
+            with self.lock:
+                if self.filter is not None:
+                    self.filter.add(key)
+
+    def might_exist(self, key):
+        self.check_fork()
+        if self.filter is None or time.time() - self.loaded > self.ttl or self.filter.count > self.filter.capacity:
+            self.rebuild()
+        state = self.catch_up() if self.filter is not None else False
+        if state is False:
+            self.rebuild()
+        if not state: # the database answers
+            return True
+        return key in self.filter
+
+account_filter = AccountFilter()
+
+def is_available(account):
+    ''' Whether an account (user name or email) is used by no user, neither as a user name nor as an email.
+        A name the filter has never seen is answered without a query, the database is only asked
+        when the filter says it may be used.
+    '''
+    key = normalize_account(account)
+    if not key:
+        return False
+    if not account_filter.might_exist(key):
+        return True
+    return not get_user_model().objects.filter(account_q(key)).exists() # users without keys included, like find_user
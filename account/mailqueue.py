@@ -0,0 +1,116 @@
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection as db_connection
+from django.db.models import Q
+from django.utils import timezone
+
+from account.models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50 # emails claimed per round
+WORKERS = 4 # threads sending at the same time, each one over its own mail connection
+MAX_ATTEMPTS = 6
+BACKOFF = 30 # seconds before the first retry, doubled at every failure
+MAX_BACKOFF = 3600
+SENDING_TIMEOUT = 600 # seconds after which an email claimed by a worker that died is claimed again
+POLL_INTERVAL = 5 # seconds the worker sleeps when the queue is empty
+
+
+def enqueue_email(subject, body, from_email, to, html=None):
+    ''' Queue an email for the send_emails worker, the request doesn't wait for the mail provider.
+        to --- list of recipients
+    '''
+    return OutboundEmail.objects.create(subject=subject, body=body, html=html, from_email=from_email,
+                                        to=','.join(to), next_attempt=timezone.now())
+
+def claim_emails(n=BATCH_SIZE):
+    ''' Mark up to n due emails as being sent by this worker and return them.
+        The emails are claimed by one conditional UPDATE that only takes the rows still due, so an email
+        claimed by another worker in between is left to it. This works on every database, unlike
+        SELECT ... FOR UPDATE SKIP LOCKED which the MySQL backend of Django 2.0 doesn't support.
+    '''
+    now = timezone.now()
+    due = Q(status='pending', next_attempt__lte=now) | \
+        Q(status='sending', updated__lt=now - timedelta(seconds=SENDING_TIMEOUT))
+    ids = list(OutboundEmail.objects.filter(due).order_by('next_attempt', 'id').values_list('id', flat=True)[:n])
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    OutboundEmail.objects.filter(due, id__in=ids).update(status='sending', updated=now, claim=token)
+    return list(OutboundEmail.objects.filter(claim=token).order_by('id'))
+
+def to_message(email, connection=None):
+    msg = EmailMultiAlternatives(email.subject, email.body, email.from_email, email.to.split(','),
+                                 connection=connection)
+    if email.html:
+        msg.attach_alternative(email.html, "text/html")
+    return msg
+
+def send_emails(emails):
+    ''' Send emails over one mail connection, return [(email, error or None)]
+    '''
+    results = []
+    try:
+        with get_connection() as connection:
+            for email in emails:
+                try:
+                    to_message(email, connection).send()
+                    results.append((email, None))
+                except Exception as e:
+                    results.append((email, e))
+    except Exception as e: # the connection could not be opened
+        done = set(email.id for email, error in results)
+        results += [(email, e) for email in emails if email.id not in done]
+    return results
+
+def record_results(results):
+    ''' Mark the emails sent or due again. The content of an email that is sent or failed for good is
+        blanked, it can hold a temporary password (ForgetPasswordView), the row keeps the subject and recipients.
+    '''
+    now = timezone.now()
+    sent = [email.id for email, error in results if error is None]
+    if sent:
+        OutboundEmail.objects.filter(id__in=sent).update(status='sent', error=None, updated=now, body='', html=None)
+    for email, error in results:
+        if error is None:
+            continue
+        attempts = email.attempts + 1
+        logger.error('Send email %s attempt %s exception:%s' % (email.id, attempts, error))
+        if attempts >= MAX_ATTEMPTS:
+            status, next_attempt = 'failed', email.next_attempt
+            content = {'body': '', 'html': None}
+        else:
+            status = 'pending'
+            next_attempt = now + timedelta(seconds=min(MAX_BACKOFF, BACKOFF * 2 ** (attempts - 1)))
+            content = {}
+        OutboundEmail.objects.filter(id=email.id).update(status=status, attempts=attempts, next_attempt=next_attempt,
+                                                         error=str(error), updated=now, **content)
+
+def process_batch(batch_size=BATCH_SIZE, workers=WORKERS):
+    ''' Claim a batch of due emails and send them with a pool of threads, return the number of emails claimed
+    '''
+    emails = claim_emails(batch_size)
+    if not emails:
+        return 0
+    chunks = [emails[i::workers] for i in range(workers) if emails[i::workers]]
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        results = [r for rs in pool.map(send_emails, chunks) for r in rs]
+    record_results(results)
+    return len(emails)
+
+def run_worker(batch_size=BATCH_SIZE, workers=WORKERS, once=False):
+    ''' Drain the queue, then wait for new emails unless once is set
+    '''
+    while True:
+        n = process_batch(batch_size, workers)
+        if once and n == 0:
+            return
+        if n == 0:
+            db_connection.close() # don't hold a database connection while idle
+            time.sleep(POLL_INTERVAL)
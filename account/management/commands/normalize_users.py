@@ -0,0 +1,61 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction, IntegrityError
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+from account.models import normalize_account
+
+
+class Command(BaseCommand):
+    help = '''Fill the lower cased username and email keys of the users. Usernames and emails that only
+        differ by case were allowed before the keys, the users sharing one are reported and left without
+        that key, find_user matches users without keys the old way.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500)
+
+    def get_shared(self, field):
+        # lower cased values of field used by several users
+        User = get_user_model()
+        return set(User.objects.exclude(**{field: ''}).exclude(**{field: None})
+                   .annotate(k=Lower(field)).values('k').annotate(n=Count('id')).filter(n__gt=1)
+                   .values_list('k', flat=True))
+
+    def report(self, field, key, uid):
+        self.stderr.write('%s "%s" of user %s is used by another user, left without key' % (field, key, uid))
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        shared = {'username': self.get_shared('username'), 'email': self.get_shared('email')}
+        n = 0
+        collisions = 0
+        last_id = 0
+        users = User.objects.order_by('id').values_list('id', 'username', 'email', 'username_key', 'email_key')
+        while True:
+            batch = list(users.filter(id__gt=last_id)[:options['batch']])
+            if not batch:
+                break
+            for uid, username, email, username_key, email_key in batch:
+                keys = {'username': normalize_account(username), 'email': normalize_account(email)}
+                for field, key in keys.items():
+                    if key in shared[field]:
+                        self.report(field, key, uid)
+                        keys[field] = None
+                        collisions += 1
+                if (keys['username'], keys['email']) == (username_key, email_key):
+                    continue
+                try:
+                    with transaction.atomic():
+                        User.objects.filter(id=uid).update(username_key=keys['username'], email_key=keys['email'])
+                except IntegrityError:
+                    # differs from another user's key by more than case, eg. spaces around it
+                    for field in ('username', 'email'):
+                        if keys[field] and User.objects.exclude(id=uid).filter(**{field + '_key': keys[field]}).exists():
+                            self.report(field, keys[field], uid)
+                            keys[field] = None
+                            collisions += 1
+                    User.objects.filter(id=uid).update(username_key=keys['username'], email_key=keys['email'])
+                n += 1
+            last_id = batch[-1][0]
+        self.stdout.write('Updated %d users, %d keys left empty because they are shared' % (n, collisions))
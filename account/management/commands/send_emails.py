@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from account.mailqueue import run_worker, BATCH_SIZE, WORKERS
+
+
+class Command(BaseCommand):
+    help = 'Send the queued emails, retrying the failed ones with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=WORKERS)
+        parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        run_worker(options['batch'], options['workers'], options['once'])
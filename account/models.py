@@ -2,15 +2,16 @@
 from __future__ import unicode_literals
 import os
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import AbstractUser
-from django.db.models import CharField, Model, ForeignKey, DateTimeField, ImageField
+from django.db.models import CharField, Model, ForeignKey, DateTimeField, ImageField, Q
 from django.conf import settings
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.utils.translation import gettext_lazy as _
 
 STATUS = (('true','True'), ('false', 'False'))
 USER_TYPES = (('member','Member'), ('business', 'Business'))
+EMAIL_STATUS = (('pending','Pending'), ('sending','Sending'), ('sent','Sent'), ('failed','Failed'))
 
 class Province(Model):
     name = CharField(max_length=64, null=True, blank = True)
@@ -63,6 +64,48 @@ class User(AbstractUser):
     email = models.EmailField(_('email address'), blank=True)
     portrait = CharField(max_length=256, null=True, blank=True) # main, google, facebook, wechat, qq, taobao
     type = CharField(max_length=16, choices=USER_TYPES, default='member')
+    # lower cased username and email, kept by save() for the case insensitive login lookup.
+    # QuerySet.update() doesn't call save(), run normalize_users after changing them that way.
+    username_key = CharField(max_length=150, unique=True, null=True, editable=False)
+    email_key = CharField(max_length=254, unique=True, null=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.username_key = normalize_account(self.username)
+        self.email_key = normalize_account(self.email)
+        if 'update_fields' in kwargs and kwargs['update_fields'] is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'username_key', 'email_key'}
+        if self.pk is None: # new users are checked with account_exists first
+            return super().save(*args, **kwargs)
+        try:
+            with transaction.atomic():
+                return super().save(*args, **kwargs)
+        except IntegrityError:
+            # the username or email is shared with another user, which was allowed before the keys,
+            # the user is kept without that key, see normalize_users
+            others = type(self).objects.exclude(pk=self.pk)
+            if self.username_key and others.filter(username_key=self.username_key).exists():
+                self.username_key = None
+            if self.email_key and others.filter(email_key=self.email_key).exists():
+                self.email_key = None
+            return super().save(*args, **kwargs)
+
+def normalize_account(s):
+    # key of a username or an email, None for an empty one so users without email don't collide
+    s = (s or '').strip().lower()
+    return s or None
+
+def legacy_account_q(key):
+    # users using the lower cased account key in a column left without key (not reached by
+    # normalize_users yet, or shared by several users), matched the old way
+    return Q(username_key=None, username__iexact=key) | Q(email_key=None, email__iexact=key)
+
+def account_q(*accounts):
+    # users using any of the accounts as user name or email, through their keys or the old way
+    keys = [key for key in map(normalize_account, accounts) if key]
+    q = Q(username_key__in=keys) | Q(email_key__in=keys)
+    for key in keys:
+        q |= legacy_account_q(key)
+    return q
         
 def get_upload_image_path(instance, fpath):
     user_id = '0'
@@ -95,3 +138,21 @@ class Feedback(Model):
     message = CharField(max_length=255, null=True, blank=True)
     created = DateTimeField(auto_now_add=True)
     updated = DateTimeField(auto_now=True)
+
+class OutboundEmail(Model):
+    # email waiting to be sent by the send_emails worker, see account.mailqueue
+    subject = CharField(max_length=255)
+    body = models.TextField(blank=True)
+    html = models.TextField(null=True, blank=True)
+    from_email = CharField(max_length=254)
+    to = models.TextField() # recipients separated by commas
+    status = CharField(max_length=16, choices=EMAIL_STATUS, default='pending')
+    attempts = models.IntegerField(default=0)
+    next_attempt = DateTimeField()
+    error = models.TextField(null=True, blank=True)
+    claim = CharField(max_length=32, null=True, blank=True) # token of the worker round that claimed the email
+    created = DateTimeField(auto_now_add=True)
+    updated = DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt']), models.Index(fields=['claim'])]
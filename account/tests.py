@@ -1,3 +1,175 @@
+import json
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
+
+from account import mailqueue
+from account.availability import AccountFilter, log_key
+from account.models import OutboundEmail
+from account.views import find_user, account_exists
+
+
+class EmailQueueTest(TestCase):
+    def test_views_enqueue(self):
+        r = self.client.post('/api/contact', json.dumps({'name':'n', 'email':'a@example.com', 'phone':'1', 'message':'m'}),
+                             content_type='application/json')
+        self.assertEqual(r.json(), {'send':'0'})
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboundEmail.objects.get().status, 'pending')
+
+        self.assertEqual(mailqueue.process_batch(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].alternatives[0][1], 'text/html')
+        self.assertEqual(OutboundEmail.objects.get().status, 'sent')
+
+    def test_batch(self):
+        for i in range(7):
+            mailqueue.enqueue_email('s%s' % i, 'b', 'a@example.com', ['b@example.com', 'c@example.com'])
+        self.assertEqual(mailqueue.process_batch(batch_size=5, workers=3), 5)
+        self.assertEqual(mailqueue.process_batch(batch_size=5, workers=3), 2)
+        self.assertEqual(mailqueue.process_batch(batch_size=5, workers=3), 0)
+        self.assertEqual(sorted(m.subject for m in mail.outbox), ['s%s' % i for i in range(7)])
+        self.assertEqual(mail.outbox[0].to, ['b@example.com', 'c@example.com'])
+
+    def test_retry_with_backoff(self):
+        email = mailqueue.enqueue_email('s', 'b', 'a@example.com', ['b@example.com'])
+        with mock.patch('account.mailqueue.get_connection', side_effect=OSError('down')):
+            mailqueue.process_batch()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.error), ('pending', 1, 'down'))
+        self.assertGreater(email.next_attempt, timezone.now() + timedelta(seconds=mailqueue.BACKOFF - 5))
+        self.assertEqual(mailqueue.process_batch(), 0) # not due yet
+
+        OutboundEmail.objects.update(next_attempt=timezone.now(), attempts=mailqueue.MAX_ATTEMPTS - 1)
+        with mock.patch('account.mailqueue.get_connection', side_effect=OSError('down')):
+            mailqueue.process_batch()
+        self.assertEqual(OutboundEmail.objects.get().status, 'failed')
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_content_blanked(self):
+        # the body can hold a temporary password, it is only kept while the email may still be sent
+        sent = mailqueue.enqueue_email('s', 'password: x1', 'a@example.com', ['b@example.com'], html='<p>x1</p>')
+        mailqueue.process_batch()
+        failing = mailqueue.enqueue_email('s', 'password: x2', 'a@example.com', ['c@example.com'], html='<p>x2</p>')
+        with mock.patch('account.mailqueue.get_connection', side_effect=OSError('down')):
+            mailqueue.process_batch()
+        failing.refresh_from_db()
+        self.assertEqual((failing.status, failing.body), ('pending', 'password: x2'))
+
+        OutboundEmail.objects.filter(id=failing.id).update(next_attempt=timezone.now(), attempts=mailqueue.MAX_ATTEMPTS - 1)
+        with mock.patch('account.mailqueue.get_connection', side_effect=OSError('down')):
+            mailqueue.process_batch()
+        for email, status in ((sent, 'sent'), (failing, 'failed')):
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.body, email.html), (status, '', None))
+        self.assertEqual(mail.outbox[0].body, 'password: x1')
+
+    def test_claim_once(self):
+        for i in range(5):
+            mailqueue.enqueue_email('s%s' % i, 'b', 'a@example.com', ['b@example.com'])
+        first = mailqueue.claim_emails(3)
+        self.assertEqual(len(first), 3)
+        # another worker only gets the emails left
+        second = mailqueue.claim_emails(5)
+        self.assertEqual(sorted(e.id for e in second), sorted(OutboundEmail.objects.exclude(id__in=[e.id for e in first])
+                                                              .values_list('id', flat=True)))
+        self.assertNotEqual(first[0].claim, second[0].claim)
+        self.assertEqual(mailqueue.claim_emails(5), [])
+
+
+class NormalizeUsersTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.bob = User.objects.create(username='Bob', email='shared@example.com')
+        self.ann = User.objects.create(username='ann', email='ann@example.com')
+        self.joe = User.objects.create(username='Joe', email='joe@example.com')
+        # users from before the keys, when emails differing by case were allowed
+        User.objects.update(username_key=None, email_key=None)
+        User.objects.filter(id=self.ann.id).update(email='SHARED@example.com')
+        self.ann.refresh_from_db()
+
+    def test_find_before_backfill(self):
+        self.assertEqual(find_user('bob'), self.bob)
+        self.assertEqual(find_user('JOE@example.com'), self.joe)
+        self.assertIsNone(find_user('shared@example.com')) # ambiguous
+
+    @mock.patch('account.availability.AccountFilter.rebuild') # no filter, the database answers
+    def test_exists_before_backfill(self, rebuild):
+        for account in ('BOB', 'joe@example.com', 'shared@example.com'):
+            self.assertTrue(account_exists('new', account))
+            self.assertFalse(self.client.get('/api/availability?account=' + account).json()['available'])
+        self.assertFalse(account_exists('new', 'new@example.com'))
+        self.assertTrue(self.client.get('/api/availability?account=new').json()['available'])
+
+    def test_shared_keys(self):
+        err = StringIO()
+        call_command('normalize_users', stdout=StringIO(), stderr=err)
+        self.assertEqual(err.getvalue().count('shared@example.com'), 2)
+        keys = dict(get_user_model().objects.values_list('id', 'email_key'))
+        self.assertEqual(keys, {self.bob.id: None, self.ann.id: None, self.joe.id: 'joe@example.com'})
+        self.assertEqual(find_user('BOB'), self.bob)
+        self.assertEqual(find_user('joe@example.com'), self.joe)
+        self.assertIsNone(find_user('shared@example.com'))
+
+        # saving a user that shares its email keeps working
+        self.ann.first_name = 'Ann'
+        self.ann.save()
+        self.bob.save(update_fields=['last_login'])
+        self.bob.refresh_from_db()
+        self.assertEqual((self.bob.username_key, self.bob.email_key), ('bob', None))
+
+
+@mock.patch('account.availability.AccountFilter.rebuild') # the tests load the filters by hand
+class AccountFilterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_user_model().objects.create(username='Bob', email='bob@example.com')
+        self.filters = [AccountFilter(), AccountFilter()] # two worker processes
+        for f in self.filters:
+            f.load()
+
+    def test_shared_adds(self, rebuild):
+        a, b = self.filters
+        self.assertTrue(b.might_exist('bob'))
+        self.assertFalse(b.might_exist('ann'))
+        a.add('Ann', 'ann@example.com')
+        self.assertTrue(a.might_exist('ann'))
+        self.assertTrue(b.might_exist('ann'))
+        self.assertTrue(b.might_exist('ann@example.com'))
+        rebuild.assert_not_called()
+
+    def test_lost_log(self, rebuild):
+        a, b = self.filters
+        a.add('ann')
+        a.add('joe')
+        cache.delete(log_key(1)) # evicted
+        self.assertTrue(b.might_exist('nobody')) # the database answers
+        rebuild.assert_called_once_with()
+
+        b.load()
+        self.assertFalse(b.might_exist('nobody'))
+        a.add('sue')
+        self.assertTrue(b.might_exist('sue'))
+        cache.clear() # the version counter is reset too
+        a.add('max')
+        self.assertTrue(b.might_exist('nobody'))
+        self.assertEqual(rebuild.call_count, 2)
 
-# Create your tests here.
+    def test_forked(self, rebuild):
+        # forked (gunicorn --preload) while the parent's thread was loading a filter and holding the lock,
+        # the child starts its own load
+        f = AccountFilter()
+        f.rebuilding = True
+        f.lock.acquire()
+        f.pid = -1
+        self.assertTrue(f.might_exist('bob')) # the database answers
+        self.assertTrue(rebuild.called)
+        self.assertFalse(f.rebuilding)
+        self.assertFalse(f.lock.locked())
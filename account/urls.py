@@ -1,11 +1,14 @@
 from django.conf.urls import url
-from account.views import AddressView, LoginView, SignupView, InstitutionView, TokenView, UserView, UserFormView
+from account.views import AddressView, LoginView, SignupView, InstitutionView, TokenView, UserView, UserFormView, AvailabilityView, ForgetPasswordView, ContactUsView
 
 urlpatterns = [
     url('login', LoginView.as_view()),
     url('^signup', SignupView.as_view()),
     url('^institutionsignup', InstitutionView.as_view()),
     url('token', TokenView.as_view()),
+    url('availability', AvailabilityView.as_view()),
+    url('forget-password', ForgetPasswordView.as_view()),
+    url('contact', ContactUsView.as_view()),
 
     url('users/(?P<id>[0-9]+)', UserView.as_view()),
     url('users', UserView.as_view()),
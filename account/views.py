@@ -6,7 +6,6 @@ import os
 import logging
 
 from datetime import datetime
-from django.core.mail import send_mail, EmailMultiAlternatives
 from django.http import JsonResponse
 from django.db.models import Q
 from django.contrib.auth import authenticate, login, get_user_model
@@ -16,8 +15,12 @@ from django.utils.decorators import method_decorator
 from django.conf import settings
 
 from commerce.models import Restaurant
-from account.models import Province, City, Address
-from utils import to_json, create_jwt_token, get_data_from_token
+from commerce.geo import update_restaurant_index
+from commerce.images import ingest_image
+from account.models import Province, City, Address, normalize_account, account_q, legacy_account_q
+from account.availability import account_filter, is_available
+from account.mailqueue import enqueue_email
+from utils import to_json, create_jwt_token, get_token_data, paginate, write_upload, InvalidCursor
 
 ERR_USER_EXIST = 1
 ERR_USER_DUPLICATED = 2
@@ -60,15 +63,34 @@ def save_user(id, username, email, password, utype, firstname='', lastname='', p
             user.save()
         except Exception as e:
             pass
+    if user is not None:
+        account_filter.add(user.username, user.email)
     return user
 
 def find_user(account):
-    # both user name and email must be unique
+    # both user name and email must be unique, they are matched through their lower cased unique keys.
+    # Users without keys, not reached by normalize_users yet or sharing them with another user,
+    # are matched the old way, among those rows only.
+    key = normalize_account(account)
+    if not key:
+        return None
+    users = get_user_model().objects
+    try:
+        return users.get(Q(username_key=key) | Q(email_key=key))
+    except Exception:
+        pass
     try:
-        return get_user_model().objects.get(Q(username__iexact=account) | Q(email__iexact=account))
+        return users.get(legacy_account_q(key))
     except Exception:
         return None
 
+def account_exists(*accounts):
+    # whether any of the accounts (user names or emails) is already used as a user name or an email,
+    # answered with one query, users without keys included like find_user does
+    if not any(map(normalize_account, accounts)):
+        return False
+    return get_user_model().objects.filter(account_q(*accounts)).exists()
+
 @method_decorator(csrf_exempt, name='dispatch')
 class AddressView(View):
     def getList(self):
@@ -130,7 +152,7 @@ class SignupView(View):
         else:
             return JsonResponse({'token':'', 'user':''})
         
-        if find_user(email) or find_user(username):
+        if account_exists(username, email):
             return JsonResponse({'token':'', 'user':''})
         else: # username, email cannot be empty
             user = save_user(None, username, email, password, utype)
@@ -142,6 +164,15 @@ class SignupView(View):
             else:
                 return JsonResponse({'token':'', 'data':''})
         
+@method_decorator(csrf_exempt, name='dispatch')
+class AvailabilityView(View):
+    def get(self, req, *args, **kwargs):
+        ''' Check a user name or an email while the signup form is typed in,
+            ?account=xxx returns {'available': true} when no user uses it as user name or email
+        '''
+        account = req.GET.get('account')
+        return JsonResponse({'available':is_available(account)})
+
 @method_decorator(csrf_exempt, name='dispatch')
 class LoginView(View):
     def post(self, req, *args, **kwargs):
@@ -176,18 +207,14 @@ class LoginView(View):
 @method_decorator(csrf_exempt, name='dispatch')
 class TokenView(View):
     def get(self, req, *args, **kwargs):
-        authorizaion = req.META['HTTP_AUTHORIZATION']
-        token = authorizaion.replace("Bearer ", "")
-        data = get_data_from_token(token)
+        data = get_token_data(req)
         if data:
             return JsonResponse({'data':data})
         else:
             return JsonResponse({'data':''})
 
     def post(self, req, *args, **kwargs):
-        authorizaion = req.META['HTTP_AUTHORIZATION']
-        token = authorizaion.replace("Bearer ", "")
-        data = get_data_from_token(token)
+        data = get_token_data(req)
         if data:
             return JsonResponse({'data':data})
         else:
@@ -199,24 +226,26 @@ class UserView(View):
     def getList(self, req):
         utype = req.GET.get('type')
         users = []
+        page = {}
         try:
             if utype:
                 users = get_user_model().objects.filter(type=utype)
+                users, page = paginate(users, req, ('date_joined', 'id'))
             else:
                 users = []#get_user_model().objects.all().order_by('created')#.annotate(n_products=Count('product'))
             
+        except InvalidCursor:
+            raise
         except Exception:
             return JsonResponse({'data':[]})
         
         a = []
         for user in users:
             a.append({'id':user.id, 'username':user.username, 'email':user.email, 'password':''})
-        return JsonResponse({'data': a})
+        return JsonResponse({'data': a, **page})
 
     def get(self, req, *args, **kwargs):
-        authorizaion = req.META['HTTP_AUTHORIZATION']
-        token = authorizaion.replace("Bearer ", "")
-        data = get_data_from_token(token)
+        data = get_token_data(req)
         if data:
             uid = int(kwargs.get('id')) if kwargs.get('id') else None
             if uid:
@@ -252,7 +281,7 @@ class UserView(View):
             user = get_user_model().objects.get(id=id)
             user = save_user(id, username, email, password, utype)
         else:
-            if find_user(email) or find_user(username):
+            if account_exists(username, email):
                 return JsonResponse({'token':'', 'user':''})
             else: # username, email cannot be empty
                 user = save_user(id, username, email, password, utype)
@@ -268,7 +297,7 @@ class UserView(View):
 @method_decorator(csrf_exempt, name='dispatch')
 class UserFormView(View):
     def get(self, req, *args, **kwargs):
-        if get_data_from_token(req):
+        if get_token_data(req):
             _id = int(kwargs.get('id'));
             user = None
             try:
@@ -296,13 +325,7 @@ class InstitutionView(View):
         lastname = 'me'#params.get('lastname')
         utype = 'business'#params.get('type')
         portrait = ''#params.get('portrait')
-        r = None
-        try:
-            r = get_user_model().objects.get(email__iexact=email)
-        except Exception:  # models.DoesNotExist:
-            pass
-        
-        if r:
+        if account_exists(username, email):
             return JsonResponse({'token':'', 'user':'', 'errors':[ERR_USER_EXIST]})
         else: # assume username, email alwayse have value
             
@@ -327,9 +350,9 @@ class InstitutionView(View):
         item.admin = user
         item.address = self.createAddress(params)
         item.save()
-        if image:        
-            item.image.save(image.name, image.file, True)
-        item.save()
+        if image: # saves item again, the image is finalized in the background
+            ingest_image(item, image)
+        update_restaurant_index(item)
         #return JsonResponse({'data':to_json(item)})
         return item
     
@@ -518,12 +541,7 @@ class PortraitView(View):
             os.makedirs(fpath)
 
         full_filename = os.path.join(fpath, user_id + ext)
-        if os.path.exists(full_filename):
-            os.remove(full_filename)
-        
-        fout = open(full_filename, 'wb+')
-        fout.write(file.read())
-        fout.close()
+        write_upload(file, full_filename) # replaces the previous portrait once the new one is written
         return full_filename
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -544,11 +562,11 @@ class ForgetPasswordView(View):
                 return JsonResponse({'errors':[ERR_USER_NOT_EXIST]})
             
             password = get_user_model().objects.make_random_password()
-            self.send_temp_password_email(from_email, to_email, password)
             
             try:
                 user.set_password(password)
                 user.save()
+                self.send_temp_password_email(from_email, to_email, password)
                 return JsonResponse({'errors':[]})
             except Exception as e:
                 logger.error('set password exception:%s'%e)
@@ -560,7 +578,7 @@ class ForgetPasswordView(View):
         subject = "Your password has changed"
         body = "A temporary password has been sent to your email address. You will then be able to log in and change your password.\nYour new password: %s"%password
         try:
-            send_mail(subject, body, from_email, [to_email])
+            enqueue_email(subject, body, from_email, [to_email]) # sent by the send_emails worker
         except Exception as e:
             logger.error('Send temporary password exception:%s'%e)
 
@@ -617,9 +635,7 @@ class ContactUsView(View):
         text_content = 'Thank you for contacting us.'
         try:
             html_content = '<p>客户名称：'+name+'</p>'+'<p>客户电话：'+phone+'</p>'+'<p>发送信息：'+message+'</p>';
-            msg = EmailMultiAlternatives(subject, text_content, from_email, [to_email])
-            msg.attach_alternative(html_content, "text/html")
-            msg.send()  
+            enqueue_email(subject, text_content, from_email, [to_email], html_content) # sent by the send_emails worker
             return JsonResponse({'send':'0'})
         except Exception as e:
             logger.error('Failed to send email: '+ str(e))
@@ -7,7 +7,7 @@ from django.views.generic import View
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.conf import settings
-from utils import to_json, get_data_from_token
+from utils import to_json, stream_json_response, paginate, get_data_from_token
 
 
 from blog.models import Post, Comment
@@ -19,7 +19,10 @@ class PostListView(View):
             items = Post.objects.all().order_by('-updated')
         except Exception as e:
             return JsonResponse({'data':[]})
-        return JsonResponse({'data':to_json(items)})
+        items, page = paginate(items, req, ('-updated', '-id'))
+        if req.GET.get('stream') and not page:
+            return stream_json_response(items)
+        return JsonResponse({'data':to_json(items), **page})
 
 @method_decorator(csrf_exempt, name='dispatch')
 class PostView(View):
@@ -75,7 +78,10 @@ class CommentListView(View):
             items = Comment.objects.all().order_by('-updated')
         except Exception as e:
             return JsonResponse({'data':[]})
-        return JsonResponse({'data':to_json(items)})
+        items, page = paginate(items, req, ('-updated', '-id'))
+        if req.GET.get('stream') and not page:
+            return stream_json_response(items)
+        return JsonResponse({'data':to_json(items), **page})
 
 @method_decorator(csrf_exempt, name='dispatch')
 class CommentView(View):
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class CommerceConfig(AppConfig):
     name = 'commerce'
+
+    def ready(self):
+        import commerce.facets # connect the facet cache invalidation signals
@@ -1,6 +1,7 @@
 import json
 import logging
 
+from django.db.models import Sum
 from django.http import JsonResponse
 from django.views.generic import View
 from django.utils.decorators import method_decorator
@@ -8,7 +9,10 @@ from django.views.decorators.csrf import csrf_exempt
 from commerce.models import Cart, CartItem
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
-from commerce.models import Picture, Product
+from commerce.models import Product
+from commerce import cartstore
+from commerce.views import groupPictures
+from utils import obj_to_json, list_to_json
 
 logger = logging.getLogger(__name__)
 
@@ -21,30 +25,30 @@ class CartView(View):
             buyer_id = None
         
         try:
+            cartstore.flush_cart(buyer_id)
             cart = Cart.objects.get(user_id=buyer_id)
             # find products for cart_product
             rs = self.get_items(cart)
 
-            return JsonResponse({'cart':cart.to_json(), 'items':rs})
+            return JsonResponse({'cart':obj_to_json(cart), 'items':rs, 'nProducts':self.count_products(cart)})
 
-        except ObjectDoesNotExist:
+        except (ObjectDoesNotExist, ValueError):
             return JsonResponse({'cart':'', 'items':[]})
 
     def get_items(self, cart):
-        rs = []
-        cis = CartItem.objects.filter(cart_id=cart.id)
-        for ci in cis:
-            c = ci.to_json();
-            
-            items = Picture.objects.filter(product_id=ci.product.id)
-            ps = []
-            for item in items:
-                ps.append(item.to_json())
-
-            c['product']['items'] = ps
-            rs.append(c)
+        # the items come with their product in one query, the pictures of all the products with one more
+        cis = list(CartItem.objects.filter(cart_id=cart.id).select_related('product', 'cart').order_by('id'))
+        rs = list_to_json(cis, related_lookup=True)
+        groups = groupPictures([ci.product_id for ci in cis])
+        for ci, c in zip(cis, rs):
+            if c.get('product'):
+                c['product']['items'] = groups.get(ci.product_id, [])
         return rs
 
+    def count_products(self, cart):
+        n = CartItem.objects.filter(cart_id=cart.id).aggregate(n=Sum('quantity'))['n']
+        return n or 0
+
     def get_cart(self, buyer_id):
         cart = None
         try:
@@ -55,40 +59,18 @@ class CartView(View):
             cart.save()
         return cart
 
-    def add_product_to_cart(self, buyer_id, product_id):
-        cart = self.get_cart(buyer_id)        
-        try:
-            item = CartItem.objects.get(cart_id=cart.id, product_id=product_id)
-            item.quantity += 1
-            item.save()
-        except ObjectDoesNotExist:
-            item = CartItem()
-            item.quantity = 1
-            item.cart = cart
-            try:
-                product = Product.objects.get(id=product_id)
-                item.product = product
-                item.save()
-            except Exception as e:
-                logger.error("Exception Product doesn't exist: %s"%e)
-        return cart
-
-    def get_num_of_products(self, cart):
-        items = CartItem.objects.filter(cart_id=cart.id)
-        n = 0
-        for item in items:
-            n += item.quantity
-        return n
-
     def post(self, req, *args, **kwargs):
         ''' Add item to cart, create cart if not exist, only return the product just added
+            The item is written to the database in the background by cartstore, nProducts comes from the cache.
         '''
         ubody = req.body.decode('utf-8')
         params = json.loads(ubody)
         buyer_id = params.get('buyer_id')
         product_id = params.get('product_id')
-        cart = self.add_product_to_cart(buyer_id, product_id)
-        n = self.get_num_of_products(cart)
+        try:
+            n = cartstore.add_product(buyer_id, product_id)
+        except ValueError as e:
+            return JsonResponse({'errors':[str(e)]}, status=400)
 
         return JsonResponse({'nProducts':n})
 
@@ -97,22 +79,12 @@ class CartView(View):
         '''
         buyer_id = req.GET.get('buyer_id')
         product_id = req.GET.get('product_id')
-        cart = self.get_cart(buyer_id)
+        try:
+            n = cartstore.remove_product(buyer_id, product_id) # without product_id the cart is emptied
+        except ValueError as e:
+            return JsonResponse({'errors':[str(e)]}, status=400)
 
-        if product_id:
-            try:
-                item = CartItem.objects.get(cart_id=cart.id, product_id=product_id)
-                if item.quantity > 1:
-                    item.quantity -= 1
-                    item.save()
-                else:
-                    CartItem.objects.filter(cart_id=cart.id, product_id=product_id).delete()
-            except ObjectDoesNotExist:
-                pass
-        else: # delete all
-            CartItem.objects.filter(cart_id=cart.id).delete()
-        
+        cart = self.get_cart(buyer_id)
         items = self.get_items(cart)    
-        n = self.get_num_of_products(cart)
         return JsonResponse({'nProducts':n, 'items':items})
 
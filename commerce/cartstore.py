@@ -0,0 +1,221 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F, Sum
+
+from commerce.models import Cart, CartItem, Product
+
+logger = logging.getLogger(__name__)
+
+CART_TIMEOUT = 30 * 24 * 3600 # seconds an idle cart count stays in the cache
+FLUSH_INTERVAL = 5 # seconds between two write-behind rounds
+GAP_TIMEOUT = 60 # seconds a missing entry of a cart log is waited for before it is skipped
+
+# Each product added to a cart is appended to a log of the cart in the cache shared by the processes:
+# cart:seq:<buyer> is the number of entries and cart:op:<buyer>:<i> the product id of entry i. Cart.flushed
+# is the number of entries already written to CartItem, it is advanced in the same transaction as the
+# items, so whichever process flushes an entry writes it once. The cache named by CART_CACHE must not
+# evict these keys, see core.settings.
+_dirty = set() # buyers this process added to since its last flush round
+_lock = threading.Lock()
+_flusher = None
+
+
+def get_cache():
+    return caches[getattr(settings, 'CART_CACHE', 'default')]
+
+def count_key(buyer_id):
+    return 'cart:n:%s' % buyer_id
+
+def seq_key(buyer_id):
+    return 'cart:seq:%s' % buyer_id
+
+def op_key(buyer_id, i):
+    return 'cart:op:%s:%s' % (buyer_id, i)
+
+def to_id(value):
+    ''' int of a buyer or product id, ValueError for anything else
+    '''
+    try:
+        n = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid id: %s' % value)
+    if n <= 0:
+        raise ValueError('Invalid id: %s' % value)
+    return n
+
+def flushed_seq(buyer_id):
+    return Cart.objects.filter(user_id=buyer_id).values_list('flushed', flat=True).first() or 0
+
+def next_seq(buyer_id):
+    # index of a new entry of the log, the log goes on from Cart.flushed when the cache lost it
+    cache = get_cache()
+    try:
+        return cache.incr(seq_key(buyer_id))
+    except ValueError:
+        cache.add(seq_key(buyer_id), flushed_seq(buyer_id), None)
+        return cache.incr(seq_key(buyer_id))
+
+def count_from_db(buyer_id):
+    n = CartItem.objects.filter(cart__user_id=buyer_id).aggregate(n=Sum('quantity'))['n'] or 0
+    seq = get_cache().get(seq_key(buyer_id)) or 0
+    return n + max(seq - flushed_seq(buyer_id), 0)
+
+def count_products(buyer_id):
+    ''' Number of products in the cart, read from the cache, the database only on a miss
+    '''
+    buyer_id = to_id(buyer_id)
+    cache = get_cache()
+    n = cache.get(count_key(buyer_id))
+    if n is None:
+        n = count_from_db(buyer_id)
+        cache.set(count_key(buyer_id), n, CART_TIMEOUT)
+    return n
+
+def uncount(buyer_id, n):
+    # take n products off the cached count, a count that isn't cached is read from the database next time
+    if n:
+        try:
+            get_cache().decr(count_key(buyer_id), n)
+        except ValueError:
+            pass
+
+def add_product(buyer_id, product_id):
+    ''' Add one product to the cart without any query once the log and the count are cached,
+        return the number of products in the cart
+    '''
+    buyer_id, product_id = to_id(buyer_id), to_id(product_id)
+    cache = get_cache()
+    cache.set(op_key(buyer_id, next_seq(buyer_id)), product_id, None)
+    with _lock:
+        _dirty.add(buyer_id)
+    start_flusher()
+    try:
+        return cache.incr(count_key(buyer_id)) # atomic, two clicks can't lose one
+    except ValueError: # not cached, the entry above is counted with the unflushed ones
+        n = count_from_db(buyer_id)
+        if cache.add(count_key(buyer_id), n, CART_TIMEOUT):
+            return n
+        return cache.incr(count_key(buyer_id)) # cached by another request meanwhile
+
+def remove_product(buyer_id, product_id=None):
+    ''' Remove one of a product from the cart, or every product without product_id.
+        Unlike adding, this is written to the database right away, after the log of the cart.
+        return the number of products in the cart
+    '''
+    buyer_id = to_id(buyer_id)
+    product_id = to_id(product_id) if product_id else None
+    with transaction.atomic():
+        flush_cart(buyer_id)
+        items = CartItem.objects.filter(cart__user_id=buyer_id)
+        if product_id:
+            removed = items.filter(product_id=product_id, quantity__gt=0).update(quantity=F('quantity') - 1)
+            items.filter(quantity__lte=0).delete()
+        else:
+            removed = items.aggregate(n=Sum('quantity'))['n'] or 0
+            items.delete()
+    # the count is decremented, not rebuilt, products added meanwhile by other processes stay counted
+    uncount(buyer_id, removed)
+    return count_products(buyer_id)
+
+def get_cart(buyer_id):
+    # the cart row of a buyer, locked until the end of the transaction
+    try:
+        with transaction.atomic():
+            Cart.objects.get_or_create(user_id=buyer_id)
+    except IntegrityError: # created by another process in between
+        pass
+    return Cart.objects.select_for_update().get(user_id=buyer_id)
+
+def gap_expired(buyer_id, i):
+    # an entry is missing while its index was taken: it is being written, or the process writing it died
+    since = get_cache().get_or_set('cart:gap:%s:%s' % (buyer_id, i), time.time(), GAP_TIMEOUT * 2)
+    return time.time() - since > GAP_TIMEOUT
+
+def read_log(buyer_id, start):
+    ''' product ids of the entries of a buyer's log after start, up to the first one still being written,
+        and the index of the last entry read
+    '''
+    end = get_cache().get(seq_key(buyer_id)) or 0
+    found = get_cache().get_many([op_key(buyer_id, i) for i in range(start + 1, end + 1)])
+    pids = []
+    last = start
+    for i in range(start + 1, end + 1):
+        pid = found.get(op_key(buyer_id, i))
+        if pid is None:
+            if not gap_expired(buyer_id, i):
+                break
+            logger.error('Cart %s lost entry %s of its log' % (buyer_id, i))
+        else:
+            pids.append(pid)
+        last = i
+    return pids, last
+
+def apply_changes(cart, pids):
+    ''' Add the products to the CartItems of a cart, products that no longer exist are dropped.
+        return the number of products dropped
+    '''
+    changes = {}
+    for pid in pids:
+        changes[pid] = changes.get(pid, 0) + 1
+    valid = set(Product.objects.filter(id__in=list(changes)).values_list('id', flat=True))
+    existing = set(CartItem.objects.filter(cart_id=cart.id, product_id__in=list(valid)).values_list('product_id', flat=True))
+    for pid in existing:
+        CartItem.objects.filter(cart_id=cart.id, product_id=pid).update(quantity=F('quantity') + changes[pid])
+    CartItem.objects.bulk_create([CartItem(cart=cart, product_id=pid, quantity=changes[pid])
+                                  for pid in valid if pid not in existing])
+    return sum(n for pid, n in changes.items() if pid not in valid)
+
+def flush_cart(buyer_id):
+    ''' Write the entries of a buyer's cart log that are not written yet to Cart and CartItem, from any
+        process. The Cart row is locked so flushes of the same cart run one after the other.
+    '''
+    buyer_id = to_id(buyer_id)
+    with _lock:
+        _dirty.discard(buyer_id)
+    if not get_cache().get(seq_key(buyer_id)):
+        return
+    try:
+        with transaction.atomic():
+            cart = get_cart(buyer_id)
+            pids, last = read_log(buyer_id, cart.flushed)
+            if last == cart.flushed:
+                return
+            dropped = apply_changes(cart, pids)
+            Cart.objects.filter(id=cart.id).update(flushed=last)
+            done = [op_key(buyer_id, i) for i in range(cart.flushed + 1, last + 1)]
+            transaction.on_commit(lambda: (get_cache().delete_many(done), uncount(buyer_id, dropped)))
+    except Exception:
+        with _lock:
+            _dirty.add(buyer_id)
+        raise
+
+def flush_dirty():
+    with _lock:
+        buyers = list(_dirty)
+    for buyer_id in buyers:
+        try:
+            flush_cart(buyer_id)
+        except Exception as e:
+            logger.error('Flush cart %s exception:%s' % (buyer_id, e))
+
+def run_flusher():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush_dirty()
+        connection.close() # the thread has its own connection, don't keep it open between rounds
+
+def start_flusher():
+    global _flusher
+    if _flusher is None:
+        with _lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=run_flusher, name='cart-flusher', daemon=True)
+                _flusher.start()
+
+atexit.register(flush_dirty)
@@ -0,0 +1,103 @@
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from commerce.models import Category, Style, PriceRange, Product
+from utils import to_json
+
+FACETS_TIMEOUT = 600 # seconds
+VERSION_KEY = 'facets:version'
+
+
+def get_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = 1
+        cache.add(VERSION_KEY, version, None)
+    return version
+
+def invalidate_facets():
+    ''' Drop every cached facet result by moving to a new version of the keys
+    '''
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 2, None)
+
+def get_scope(restaurant_id=None, cats=None, restaurants=None):
+    ''' Products the counts are computed over, None for all products.
+        cats, restaurants --- lists of ids, the current filter of the product list
+    '''
+    q = Q()
+    if restaurant_id:
+        q &= Q(restaurant_id=restaurant_id)
+    if cats or restaurants:
+        f = Q()
+        if cats:
+            f |= Q(categories__id__in=cats)
+        if restaurants:
+            f |= Q(restaurant_id__in=restaurants)
+        q &= f
+    if not q:
+        return None
+    return Product.objects.filter(q).values('id')
+
+def count_facets(scope):
+    ''' Build the facet lists, each count comes from a single grouped aggregation
+    '''
+    through = Product.categories.through
+    links = through.objects.all() if scope is None else through.objects.filter(product_id__in=scope)
+    n_categories = dict(links.values_list('category_id').annotate(n=Count('product_id', distinct=True)))
+    categories = to_json(Category.objects.order_by('id'))
+    for c in categories:
+        c['n_products'] = n_categories.get(c['id'], 0)
+
+    # a price range holds low <= price < high
+    price_ranges = to_json(PriceRange.objects.order_by('id'))
+    if price_ranges:
+        counts = {}
+        for r in price_ranges:
+            q = Q()
+            if r['low'] is not None:
+                q &= Q(price__gte=r['low'])
+            if r['high'] is not None:
+                q &= Q(price__lt=r['high'])
+            counts['r%s' % r['id']] = Count('id', filter=q) if q else Count('id')
+        products = Product.objects.all() if scope is None else Product.objects.filter(id__in=scope)
+        n_prices = products.aggregate(**counts)
+        for r in price_ranges:
+            r['n_products'] = n_prices['r%s' % r['id']]
+
+    # products have no style field, styles are listed without counts
+    styles = to_json(Style.objects.order_by('id'))
+    return {'categories': categories, 'styles': styles, 'price_ranges': price_ranges}
+
+def get_facets(restaurant_id=None, cats=None, restaurants=None):
+    ''' Return the cached facets of a scope, computing them on a miss
+        restaurant_id, cats, restaurants --- ids as ints, ValueError otherwise
+    '''
+    cats = sorted(set(int(i) for i in cats or []))
+    restaurants = sorted(set(int(i) for i in restaurants or []))
+    key = 'facets:%s:%s:%s:%s' % (get_version(), int(restaurant_id) if restaurant_id else '',
+                                  ','.join(map(str, cats)), ','.join(map(str, restaurants)))
+    facets = cache.get(key)
+    if facets is None:
+        facets = count_facets(get_scope(restaurant_id, cats, restaurants))
+        cache.set(key, facets, FACETS_TIMEOUT)
+    return facets
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Style)
+@receiver(post_delete, sender=Style)
+@receiver(post_save, sender=PriceRange)
+@receiver(post_delete, sender=PriceRange)
+@receiver(m2m_changed, sender=Product.categories.through)
+def on_catalog_changed(sender, **kwargs):
+    action = kwargs.get('action') # only set for m2m_changed
+    if action is None or action.startswith('post_'):
+        invalidate_facets()
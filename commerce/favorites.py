@@ -0,0 +1,49 @@
+from django.db import transaction
+from django.db.models import Count, F
+
+from commerce.models import FavoriteProduct, Product
+from commerce.trending import record_activity, LIKE_WEIGHT
+
+
+def liked_product_ids(uid):
+    ''' Return the set of product ids the user likes, with one query
+    '''
+    if not uid:
+        return set()
+    return set(FavoriteProduct.objects.filter(user_id=uid, status=True).values_list('product_id', flat=True))
+
+@transaction.atomic
+def toggle_favorite(uid, pid):
+    ''' Like the product if the user doesn't like it yet, otherwise unlike it.
+        Product.like_count is changed in the database with an F() expression, the product row
+        is locked first so two toggles of the same product can't both insert a like.
+        return (liked, like_count)
+    '''
+    product = Product.objects.select_for_update().only('id', 'like_count', 'restaurant_id').get(id=pid)
+    likes = list(FavoriteProduct.objects.filter(user_id=uid, product_id=pid).values_list('id', 'status', 'created'))
+    if likes:
+        liked = False
+        FavoriteProduct.objects.filter(id__in=[like[0] for like in likes]).delete()
+        likes = [like for like in likes if like[1]]
+        if likes:
+            Product.objects.filter(id=pid).update(like_count=F('like_count') - len(likes))
+        for _, status, created in likes: # take back the trending score the like gave
+            record_activity([(pid, product.restaurant_id, -LIKE_WEIGHT)], created)
+    else:
+        liked = True
+        like = FavoriteProduct.objects.create(user_id=uid, product_id=pid, status=True)
+        Product.objects.filter(id=pid).update(like_count=F('like_count') + 1)
+        record_activity([(pid, product.restaurant_id, LIKE_WEIGHT)], like.created)
+    product.refresh_from_db(fields=['like_count'])
+    return liked, product.like_count
+
+def recount_likes():
+    ''' Recompute like_count of every product from FavoriteProduct, return the number of products changed
+    '''
+    counts = dict(FavoriteProduct.objects.filter(status=True).values_list('product_id').annotate(n=Count('id')))
+    n = 0
+    for pid, like_count in Product.objects.values_list('id', 'like_count'):
+        if like_count != counts.get(pid, 0):
+            Product.objects.filter(id=pid).update(like_count=counts.get(pid, 0))
+            n += 1
+    return n
@@ -0,0 +1,96 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from commerce.models import Order
+from utils import keyset_after, encode_cursor, decode_cursor, load_cursor
+
+FEED_ORDER = ('updated', 'id')
+POLL_INTERVAL = 1 # seconds between two checks of the shared version when nothing wakes the waiter
+SAFETY_WINDOW = 30 # seconds an order may take to commit after it is saved and still be delivered
+
+_changed = threading.Condition()
+
+
+def version_key(rid):
+    return 'orders:version:%s' % rid
+
+def get_version(rid):
+    return cache.get(version_key(rid), 0)
+
+def notify_orders_changed(rid):
+    ''' Call after the orders of a restaurant changed (once committed). Waiters of this process wake up
+        right away, waiters of other processes see the new version at their next check of the cache.
+    '''
+    try:
+        cache.incr(version_key(rid))
+    except ValueError:
+        cache.set(version_key(rid), 1, None)
+    with _changed:
+        _changed.notify_all()
+
+def wait_for_orders(rid, version, timeout):
+    ''' Block until the orders version of the restaurant differs from version or timeout seconds passed.
+        Only the cache is read while waiting, never the database.
+        return the current version
+    '''
+    deadline = time.time() + timeout
+    while True:
+        current = get_version(rid)
+        remaining = deadline - time.time()
+        if current != version or remaining <= 0:
+            return current
+        with _changed:
+            _changed.wait(min(remaining, POLL_INTERVAL))
+
+def position(order):
+    return (order.updated, order.id)
+
+def load_watermark(watermark):
+    ''' (floor, seen) stored in a watermark: the feed position up to which every order was delivered
+        and the set of positions delivered after it, None for a watermark that is not valid
+    '''
+    values = load_cursor(watermark, len(FEED_ORDER) + 1)
+    if values is None: # watermark without the orders seen
+        values = load_cursor(watermark, len(FEED_ORDER))
+        values = values and values + [[]]
+    if not values or not isinstance(values[-1], list):
+        return None
+    floor = decode_cursor(encode_cursor(values[:-1]), Order, FEED_ORDER)
+    updated = Order._meta.get_field('updated')
+    try:
+        seen = set((updated.to_python(u), int(i)) for u, i in values[-1])
+    except (ValidationError, TypeError, ValueError):
+        return None
+    return (tuple(floor), seen) if floor else None
+
+def dump_watermark(floor, seen):
+    return encode_cursor(list(floor) + [[[u.isoformat(), i] for u, i in sorted(seen)]])
+
+def orders_since(rid, watermark=None, limit=100):
+    ''' Orders of a restaurant created or updated after the watermark, oldest change first.
+        Order.updated is set when an order is saved, before its transaction commits, so an order can
+        become visible after orders with a later updated. The watermark is held SAFETY_WINDOW behind the
+        current time and keeps the positions of the orders delivered since: that window is scanned again
+        at the next call, the orders already delivered are skipped and the late ones are returned.
+        watermark --- opaque value returned by the previous call, None for the whole history
+        return (orders, watermark) where watermark is the one to send next time
+    '''
+    orders = Order.objects.filter(restaurant_id=rid).select_related('user').order_by(*FEED_ORDER)
+    state = load_watermark(watermark) if watermark else None
+    floor, seen = state or (None, set())
+    if floor:
+        orders = orders.filter(keyset_after(FEED_ORDER, floor))
+    orders = [o for o in orders[:limit + len(seen)] if position(o) not in seen][:limit]
+
+    # every order up to the last one returned is delivered, or all of them when the page isn't full
+    holdback = (timezone.now() - timedelta(seconds=SAFETY_WINDOW), 0)
+    new_floor = min(position(orders[-1]), holdback) if len(orders) == limit else holdback
+    if floor and floor > new_floor:
+        new_floor = floor
+    seen = set(p for p in seen | set(position(o) for o in orders) if p > new_floor)
+    return orders, dump_watermark(new_floor, seen)
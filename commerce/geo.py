@@ -0,0 +1,209 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Q
+
+from commerce.models import Restaurant
+from utils import PAGE_LIMIT, MAX_PAGE_LIMIT, encode_cursor, load_cursor, InvalidCursor
+
+try:
+    import numpy as np
+except ImportError: # the in-process index is optional
+    np = None
+
+EARTH_RADIUS = 3959 # miles, same unit the distance has always been compared in
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    ''' Great circle distance between two points given in degrees
+    '''
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+def bounding_box(lat, lng, distance):
+    ''' Return the Q matching every point within distance of (lat, lng) and some points just outside it.
+        It only compares lat and lng so the (lat, lng) index can serve it.
+    '''
+    dlat = math.degrees(distance / EARTH_RADIUS)
+    lat_min, lat_max = lat - dlat, lat + dlat
+    q = Q(lat__range=(max(lat_min, -90), min(lat_max, 90)))
+    if lat_min <= -90 or lat_max >= 90:
+        return q # the circle covers a pole, every longitude qualifies
+
+    dlng = math.degrees(math.asin(min(1, math.sin(distance / EARTH_RADIUS) / math.cos(math.radians(lat)))))
+    lng_min, lng_max = lng - dlng, lng + dlng
+    if lng_min < -180:
+        return q & (Q(lng__gte=lng_min + 360) | Q(lng__lte=lng_max))
+    elif lng_max > 180:
+        return q & (Q(lng__gte=lng_min) | Q(lng__lte=lng_max - 360))
+    else:
+        return q & Q(lng__range=(lng_min, lng_max))
+
+def to_unit_vectors(lat, lng):
+    ''' lat, lng --- degrees, scalars or NumPy arrays
+    '''
+    lat = np.radians(lat)
+    lng = np.radians(lng)
+    return np.stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)], axis=-1)
+
+
+class RestaurantIndex(object):
+    ''' Restaurant ids and unit sphere vectors held in NumPy arrays, so a radius or k nearest query is a
+        few vectorized operations instead of a database round trip.
+        Rows written by this process are applied with update/remove, the whole index is reloaded
+        every ttl seconds to pick up writes made by other worker processes.
+    '''
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.loaded = None
+        self.ids = None
+        self.xyz = None
+        self.rows = {} # restaurant id -> row in ids/xyz
+
+    def load(self):
+        coords = list(Restaurant.objects.filter(lat__isnull=False, lng__isnull=False).values_list('id', 'lat', 'lng'))
+        ids = np.array([c[0] for c in coords], dtype=np.int64)
+        lats = np.array([float(c[1]) for c in coords], dtype=np.float64)
+        lngs = np.array([float(c[2]) for c in coords], dtype=np.float64)
+        with self.lock:
+            self.ids = ids
+            self.xyz = to_unit_vectors(lats, lngs).reshape(-1, 3)
+            self.rows = {int(rid): i for i, rid in enumerate(ids)}
+            self.loaded = time.time()
+
+    def ensure_loaded(self):
+        if self.loaded is None or time.time() - self.loaded > self.ttl:
+            self.load()
+
+    def update(self, restaurant):
+        ''' Add or move one restaurant after it has been saved
+        '''
+        if self.loaded is None:
+            return
+        if restaurant.lat is None or restaurant.lng is None:
+            self.remove(restaurant.id)
+            return
+        v = to_unit_vectors(float(restaurant.lat), float(restaurant.lng))
+        with self.lock:
+            # arrays are replaced, never changed in place, so a running query keeps a consistent copy
+            i = self.rows.get(restaurant.id)
+            if i is None:
+                self.rows[restaurant.id] = len(self.ids)
+                self.ids = np.append(self.ids, restaurant.id)
+                self.xyz = np.vstack([self.xyz, v])
+            else:
+                xyz = self.xyz.copy()
+                xyz[i] = v
+                self.xyz = xyz
+
+    def remove(self, rid):
+        ''' Drop one restaurant after it has been deleted, the last row takes its place
+        '''
+        if self.loaded is None:
+            return
+        with self.lock:
+            i = self.rows.pop(rid, None)
+            if i is None:
+                return
+            last = len(self.ids) - 1
+            ids = self.ids[:last].copy()
+            xyz = self.xyz[:last].copy()
+            if i != last:
+                ids[i] = self.ids[last]
+                xyz[i] = self.xyz[last]
+                self.rows[int(ids[i])] = i
+            self.ids = ids
+            self.xyz = xyz
+
+    def query(self, lat, lng, distance=None, k=None):
+        ''' Return [(distance, id)] nearest first, within distance (miles) and/or the k nearest
+        '''
+        self.ensure_loaded()
+        with self.lock:
+            ids, xyz = self.ids, self.xyz
+        if not len(ids):
+            return []
+        # chord length between unit vectors -> great circle distance, same as haversine
+        chord = np.linalg.norm(xyz - to_unit_vectors(lat, lng), axis=1)
+        d = 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
+        idx = np.arange(len(ids))
+        if distance is not None:
+            idx = idx[d[idx] < distance]
+        if k is not None and k < len(idx):
+            idx = idx[np.argpartition(d[idx], k)[:k]]
+        idx = idx[np.lexsort((ids[idx], d[idx]))]
+        return [(float(d[i]), int(ids[i])) for i in idx]
+
+restaurant_index = RestaurantIndex()
+
+def use_restaurant_index():
+    return np is not None and settings.GEO_INDEX_ENABLED
+
+def update_restaurant_index(restaurant):
+    if use_restaurant_index():
+        restaurant_index.update(restaurant)
+
+def remove_from_restaurant_index(rid):
+    if use_restaurant_index():
+        restaurant_index.remove(rid)
+
+def find_restaurants_by_location(lat, lng, distance, limit=None, cursor=None):
+    ''' Restaurants within distance (miles) of (lat, lng), nearest first.
+        The indexed bounding box query only reads id, lat and lng. The exact distance is computed on
+        those candidates and only the requested page is loaded as Restaurant objects.
+        With settings.GEO_INDEX_ENABLED and NumPy installed the candidates come from the in-process
+        restaurant_index instead of the database.
+        limit --- page size, default PAGE_LIMIT
+        cursor --- next_cursor returned with the previous page
+        return (restaurants, next_cursor), each restaurant has a distance attribute
+    '''
+    try:
+        lat = float(lat)
+        lng = float(lng)
+        distance = float(distance)
+    except (TypeError, ValueError):
+        return [], None
+    try:
+        limit = min(max(int(limit), 1), MAX_PAGE_LIMIT)
+    except (TypeError, ValueError):
+        limit = PAGE_LIMIT
+
+    if use_restaurant_index():
+        found = restaurant_index.query(lat, lng, distance)
+    else:
+        candidates = Restaurant.objects.filter(bounding_box(lat, lng, distance)).values_list('id', 'lat', 'lng')
+        found = []
+        for rid, rlat, rlng in candidates:
+            if rlat is None or rlng is None:
+                continue
+            d = haversine(lat, lng, float(rlat), float(rlng))
+            if d < distance:
+                found.append((d, rid))
+        found.sort()
+
+    if cursor:
+        after = load_cursor(cursor, 2)
+        try:
+            after = (float(after[0]), int(after[1]))
+        except (TypeError, ValueError):
+            raise InvalidCursor('Invalid cursor: %s' % cursor)
+        found = [x for x in found if x > after]
+
+    next_cursor = None
+    if len(found) > limit:
+        found = found[:limit]
+        next_cursor = encode_cursor(list(found[-1]))
+
+    items = Restaurant.objects.in_bulk([rid for d, rid in found])
+    restaurants = []
+    for d, rid in found:
+        r = items.get(rid)
+        if r:
+            r.distance = d
+            restaurants.append(r)
+    return restaurants, next_cursor
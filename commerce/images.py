@@ -0,0 +1,240 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.db import connection
+
+from commerce.models import Product
+from utils import write_upload, UPLOAD_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+STAGING_DIR = 'staging' # under MEDIA_ROOT, uploads wait there until they are finalized
+WORKERS = min(4, os.cpu_count() or 1) # processes decoding and encoding images
+MAX_SIZE = 2048 # longest edge of the finalized image, larger uploads are scaled down
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+EXIF_ORIENTATION = 0x0112
+# longest edge of each variant, a variant of name.jpg is name_small.jpg, name_small.webp, ...
+# they are derived files of the blob, removed with it
+VARIANTS = (('small', 160), ('medium', 480), ('large', 1024))
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = set() # futures not finished yet
+
+
+def variant_name(name, variant=None, ext='.jpg'):
+    ''' Name of a variant of a finalized image, the full size one without variant
+    '''
+    stem = os.path.splitext(name)[0]
+    return '%s_%s%s' % (stem, variant, ext) if variant else stem + ext
+
+def stage_upload(upload):
+    ''' Copy an uploaded file to the staging directory, return its name relative to MEDIA_ROOT
+    '''
+    ext = os.path.splitext(upload.name)[1].lower()
+    name = os.path.join(STAGING_DIR, uuid.uuid4().hex + ext)
+    write_upload(upload, default_storage.path(name))
+    return name
+
+def hash_upload(upload):
+    # sha256 hex digest of an uploaded file, read from memory or from Django's temporary file
+    sha = hashlib.sha256()
+    for chunk in upload.chunks(UPLOAD_CHUNK_SIZE):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def save_atomic(image, path, *args, **kwargs):
+    # write next to path then rename, a file of the blob is there whole or not at all
+    tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    image.save(tmp, *args, **kwargs)
+    os.replace(tmp, path)
+
+def encode(image, path, max_size):
+    # save a progressive JPEG and, when Pillow is built with libwebp, a WebP of the image scaled down to max_size
+    from PIL import Image, features
+    image = image.copy()
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    icc = image.info.get('icc_profile')
+    if features.check('webp'):
+        save_atomic(image, os.path.splitext(path)[0] + '.webp', 'WEBP', quality=WEBP_QUALITY, method=4, icc_profile=icc)
+    image = to_rgb(image)
+    save_atomic(image, path, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True, icc_profile=icc)
+    return image.size
+
+def to_rgb(image):
+    # JPEG has no alpha, lay the image on white
+    from PIL import Image
+    if image.mode == 'RGB':
+        return image
+    rgb = Image.new('RGB', image.size, (255, 255, 255))
+    rgb.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+    return rgb
+
+def get_orientation(im):
+    # EXIF orientation of an opened image, 1 (upright) when it has none
+    try:
+        exif = im._getexif() or {} # JPEG, Pillow 5 has no public EXIF reader
+    except Exception:
+        return 1
+    return exif.get(EXIF_ORIENTATION, 1)
+
+def to_upright(image, orientation):
+    # the transpositions of ImageOps.exif_transpose, which Pillow 5 doesn't have
+    from PIL import Image
+    ops = {
+        2: [Image.FLIP_LEFT_RIGHT],
+        3: [Image.ROTATE_180],
+        4: [Image.FLIP_TOP_BOTTOM],
+        5: [Image.FLIP_LEFT_RIGHT, Image.ROTATE_90],
+        6: [Image.ROTATE_270],
+        7: [Image.FLIP_LEFT_RIGHT, Image.ROTATE_270],
+        8: [Image.ROTATE_90],
+    }
+    for op in ops.get(orientation, []):
+        image = image.transpose(op)
+    return image
+
+def open_upright(path):
+    # decode the first frame of an image file turned the way its EXIF orientation says, as RGB or RGBA
+    from PIL import Image
+    with Image.open(path) as im:
+        im.seek(0)
+        orientation = get_orientation(im)
+        mode = 'RGBA' if 'A' in im.getbands() or 'transparency' in im.info else 'RGB'
+        # the orientation tag is lost with the EXIF data
+        return to_upright(im.convert(mode), orientation)
+
+def finalize_image(src, dest):
+    ''' Run in a worker process: decode src with Pillow, turn it upright, drop its EXIF data and write
+        dest as a progressive JPEG and a WebP, with the VARIANTS next to it.
+        src, dest --- absolute paths, dest ends with .jpg
+        return (width, height) of dest
+    '''
+    image = open_upright(src)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    size = encode(image, dest, MAX_SIZE)
+    for variant, max_size in VARIANTS:
+        encode(image, variant_name(dest, variant), max_size)
+    return size
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=WORKERS)
+        return _pool
+
+def ingest_image(instance, upload, field='image'):
+    ''' Stage an upload for the image field of a saved instance (Picture, Restaurant) and return right away.
+        The finalized image is a blob of the field's ContentAddressedStorage named by the hash of the upload,
+        a photo uploaded before gets the existing blob without any processing. Otherwise the instance
+        points to the staged file until a worker process has finalized it, then the row is updated with
+        the blob name and, when the model has them, width and height.
+        The previous image of the instance loses its reference.
+    '''
+    old = getattr(instance, field).name
+    digest = hash_upload(upload)
+    if not use_blob(instance, field, digest): # the upload is only written when it is a new photo
+        staged = stage_upload(upload)
+        getattr(instance, field).name = staged
+        instance.save()
+        submit(instance, field, staged, digest)
+    if old and old != getattr(instance, field).name:
+        getattr(instance, field).storage.delete(old)
+
+def get_blob_name(instance, field, digest):
+    f = getattr(instance, field).field
+    directory = os.path.dirname(f.generate_filename(instance, 'image.jpg'))
+    return f.storage.blob_name(directory, digest, '.jpg')
+
+def use_blob(instance, field, digest):
+    # point the instance to the blob of an upload seen before, return False when it is new
+    model = type(instance)
+    storage = getattr(instance, field).field.storage
+    name = get_blob_name(instance, field, digest)
+    if not storage.exists(name):
+        return False
+    storage.add_ref(name)
+    if not storage.exists(name): # removed with its last reference meanwhile
+        storage.delete(name)
+        return False
+    getattr(instance, field).name = name
+    if has_dimensions(model):
+        instance.width, instance.height = model.objects.filter(**{field: name}).exclude(width=None) \
+            .values_list('width', 'height').first() or (None, None)
+    instance.save()
+    return True
+
+def has_dimensions(model):
+    names = [f.name for f in model._meta.get_fields()]
+    return 'width' in names and 'height' in names
+
+def submit(instance, field, staged, digest):
+    model = type(instance)
+    name = get_blob_name(instance, field, digest)
+    storage = getattr(instance, field).field.storage
+    # the reference is taken before the files are written, so a delete of the same blob by its last
+    # holder meanwhile can't remove them, finish gives it back if the image is not used
+    storage.add_ref(name)
+    future = get_pool().submit(finalize_image, default_storage.path(staged), storage.path(name))
+    _pending.add(future)
+    future.add_done_callback(lambda future: finish(future, model, instance.pk, field, staged, name))
+    return future
+
+def finish(future, model, pk, field, staged, name):
+    # runs in a thread of the web process once the worker is done
+    storage = getattr(model, field).field.storage
+    try:
+        width, height = future.result()
+        values = {field: name}
+        if has_dimensions(model):
+            values.update(width=width, height=height)
+        # the image may have been replaced or removed in the meantime
+        if model.objects.filter(**{'pk': pk, field: staged}).update(**values):
+            Product.objects.filter(fpath=staged).update(fpath=name) # default picture of the product
+            default_storage.delete(staged)
+        else:
+            storage.delete(name)
+    except Exception as e:
+        logger.error('Finalize image %s exception:%s' % (staged, e))
+        storage.delete(name)
+    finally:
+        connection.close()
+        _pending.discard(future)
+
+def wait_for_images(timeout=None):
+    ''' Block until the images submitted by this process are finalized and recorded, return False on timeout
+    '''
+    deadline = None if timeout is None else time.time() + timeout
+    while _pending:
+        if deadline is not None and time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def finalize_staged(models):
+    ''' Submit again the images still staged, after a restart lost the jobs of the pool.
+        The references taken by the lost jobs are not given back, their blobs are kept longer, never lost.
+        models --- [(model class, image field name)]
+    '''
+    n = 0
+    for model, field in models:
+        for instance in model.objects.filter(**{field + '__startswith': STAGING_DIR + '/'}):
+            staged = getattr(instance, field).name
+            submit(instance, field, staged, hash_file(default_storage.path(staged)))
+            n += 1
+    return n
@@ -0,0 +1,53 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from commerce.models import Restaurant
+from commerce.geo import find_restaurants_by_location, haversine
+
+
+def full_scan(lat, lng, distance):
+    # what the old query did: compute the distance of every restaurant row
+    found = []
+    for rid, rlat, rlng in Restaurant.objects.values_list('id', 'lat', 'lng'):
+        d = haversine(lat, lng, float(rlat), float(rlng))
+        if d < distance:
+            found.append((d, rid))
+    found.sort()
+    return found[:20]
+
+
+class Command(BaseCommand):
+    help = 'Time the bounding box location search against a full scan while growing the restaurant table. Rows are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--steps', type=int, default=4)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def timeit(self, fn, repeat):
+        best = None
+        for i in range(repeat):
+            t = time.perf_counter()
+            fn()
+            t = time.perf_counter() - t
+            best = t if best is None or t < best else best
+        return best * 1000
+
+    def handle(self, *args, **options):
+        rnd = random.Random(0)
+        lat, lng, distance = 43.65, -79.38, 25 # downtown Toronto, 25 miles
+        step = options['rows'] // options['steps']
+        with transaction.atomic():
+            for i in range(options['steps']):
+                # spread over North America
+                Restaurant.objects.bulk_create([Restaurant(name='bench', lat=round(rnd.uniform(25, 60), 7),
+                                                           lng=round(rnd.uniform(-130, -60), 7))
+                                                for j in range(step)], batch_size=500)
+                n = Restaurant.objects.count()
+                indexed = self.timeit(lambda: find_restaurants_by_location(lat, lng, distance), options['repeat'])
+                scan = self.timeit(lambda: full_scan(lat, lng, distance), options['repeat'])
+                self.stdout.write('%8d restaurants  bounding box %8.1f ms  full scan %8.1f ms' % (n, indexed, scan))
+            transaction.set_rollback(True)
@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models.query import QuerySet
+from django.db.models.fields.related import ForeignKey, ManyToManyField
+from django.db.models.fields.files import ImageField
+from django.test.utils import CaptureQueriesContext
+
+from commerce.models import Category
+from utils import to_json, list_to_json
+
+
+def legacy_obj_to_json(d):
+    # obj_to_json as it was before the serialization plans, list mode only
+    item = {}
+    for field in d._meta.get_fields():
+        field_name = field.name
+        if hasattr(d, field_name):
+            v = getattr(d, field_name)
+            if isinstance(field, ManyToManyField):
+                item[field_name] = legacy_to_json(v.all())
+            elif isinstance(field, ForeignKey):
+                if v and v.id:
+                    item[field_name] = {'id': v.id }
+            elif isinstance(field, ImageField):
+                item[field_name] = { 'data':v.name if v else '', 'file':'' }
+            else:
+                item[field_name] = v
+    return item
+
+def legacy_to_json(a):
+    # to_json as it was before the single pass rewrite
+    if isinstance(a, QuerySet) and a.exists():
+        return [legacy_obj_to_json(d) for d in a]
+    elif isinstance(a, QuerySet) and a.count()==0:
+        return []
+
+
+class Command(BaseCommand):
+    help = 'Compare the legacy to_json, the instance path and the values() fast path on N categories. Rows are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        with transaction.atomic():
+            Category.objects.bulk_create([Category(name='bench%s'%i, description='') for i in range(rows)],
+                                         batch_size=500)
+            runs = [('legacy to_json', legacy_to_json),
+                    ('list_to_json', list_to_json),
+                    ('to_json (values)', to_json)]
+            for name, fn in runs:
+                best = None
+                for i in range(options['repeat']):
+                    with CaptureQueriesContext(connection) as ctx:
+                        t = time.perf_counter()
+                        fn(Category.objects.all())
+                        t = time.perf_counter() - t
+                    best = t if best is None or t < best else best
+                self.stdout.write('%-18s %8.1f ms  %d queries' % (name, best * 1000, len(ctx.captured_queries)))
+            transaction.set_rollback(True)
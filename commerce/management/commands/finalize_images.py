@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from commerce.images import finalize_staged, wait_for_images
+from commerce.models import Picture, Restaurant
+
+
+class Command(BaseCommand):
+    help = 'Finalize the uploaded images still waiting in the staging directory'
+
+    def handle(self, *args, **options):
+        n = finalize_staged([(Picture, 'image'), (Restaurant, 'image')])
+        wait_for_images()
+        self.stdout.write('Finalized %d images' % n)
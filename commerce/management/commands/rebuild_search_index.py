@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from commerce.models import Product
+from commerce.search import index_product
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product search terms of every product'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500)
+
+    def handle(self, *args, **options):
+        n = 0
+        products = Product.objects.select_related('restaurant').prefetch_related('categories').order_by('id')
+        last_id = 0
+        while True:
+            batch = list(products.filter(id__gt=last_id)[:options['batch']])
+            if not batch:
+                break
+            for product in batch:
+                index_product(product)
+            last_id = batch[-1].id
+            n += len(batch)
+        self.stdout.write('Indexed %d products' % n)
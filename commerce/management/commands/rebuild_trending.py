@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from commerce.trending import rebuild_scores
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the trending scores of the products from the likes and the orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500)
+
+    def handle(self, *args, **options):
+        n = rebuild_scores(options['batch'])
+        self.stdout.write('Scored %d products' % n)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from commerce.favorites import recount_likes
+
+
+class Command(BaseCommand):
+    help = 'Recompute the like count of every product from the favorites'
+
+    def handle(self, *args, **options):
+        n = recount_likes()
+        self.stdout.write('Updated %d products' % n)
@@ -4,6 +4,7 @@ from django.db import models
 from django.conf import settings
 from django.db.models import CharField, Model, ForeignKey, ManyToManyField, DateTimeField, DecimalField, IntegerField, ImageField, BooleanField
 from account.models import Address, get_upload_image_path
+from commerce.storage import media_storage
 
 # from itertools import count
 # from crypto import Crypto
@@ -36,12 +37,15 @@ class Restaurant(Model):
     description = CharField(max_length=800, null=True, blank=True)
     address = ForeignKey(Address, null=True, blank=True, db_column='address_id', on_delete=models.CASCADE)
     categories = ManyToManyField(Category)
-    image = ImageField(upload_to=get_restaurant_image_path)
+    image = ImageField(upload_to=get_restaurant_image_path, storage=media_storage) # named by content, see commerce.storage
     lat = DecimalField(max_digits=10, decimal_places=7, null=True)
     lng = DecimalField(max_digits=10, decimal_places=7, null=True)
     user = ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, db_column='user_id', on_delete=models.CASCADE)
     created = DateTimeField(auto_now_add=True)
     updated = DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['lat', 'lng'])] # bounding box prefilter of the location search
     
     def __str__(self):
         return self.name
@@ -80,6 +84,7 @@ class Product(Model):
     # dimension = CharField(max_length=64, null=True, blank=True)
     price = DecimalField(max_digits=10, decimal_places=3, null=True)
     currency = CharField(max_length=16, choices=CURRENCIES, default='usd')
+    like_count = IntegerField(default=0) # number of FavoriteProduct rows, kept by commerce.favorites
     created = DateTimeField(auto_now_add=True)
     updated = DateTimeField(auto_now=True)
 
@@ -93,6 +98,31 @@ class Product(Model):
     def __str__(self):
         return self.name
 
+class ProductTerm(Model):
+    # inverted index of the product search, maintained by commerce.search.index_product
+    term = CharField(max_length=32)
+    product = ForeignKey(Product, on_delete=models.CASCADE)
+    weight = IntegerField(default=1)
+
+    class Meta:
+        indexes = [models.Index(fields=['term', 'product'])]
+
+class MediaBlob(Model):
+    # number of rows using a file of commerce.storage.ContentAddressedStorage
+    name = CharField(max_length=255, unique=True)
+    refs = IntegerField(default=0)
+    created = DateTimeField(auto_now_add=True)
+
+class ProductTrend(Model):
+    # time decayed activity score of a product, maintained by commerce.trending
+    product = models.OneToOneField(Product, related_name='+', on_delete=models.CASCADE) # no reverse accessor, kept out of to_json
+    restaurant = ForeignKey(Restaurant, null=True, blank=True, on_delete=models.CASCADE)
+    score = models.FloatField(default=0) # log2 of the time scaled score, see commerce.trending
+    updated = DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['-score']), models.Index(fields=['restaurant', '-score'])]
+
 def get_upload_image_path(instance, fpath):
     import os
     fname, ext = os.path.splitext(fpath)
@@ -104,7 +134,7 @@ class Picture(Model):
     index = IntegerField(null=True)
     width = IntegerField(null=True)
     height = IntegerField(null=True)
-    image = ImageField(upload_to=get_upload_image_path)
+    image = ImageField(upload_to=get_upload_image_path, storage=media_storage) # named by content, see commerce.storage
     product = ForeignKey(Product, null=True, blank=True, db_column='product_id', on_delete=models.CASCADE)
     created = DateTimeField(auto_now_add=True)
     updated = DateTimeField(auto_now=True)
@@ -114,6 +144,7 @@ class Picture(Model):
 
 class Cart(Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    flushed = IntegerField(default=0) # entries of the cart log in the cache written to the items, see cartstore
     created = DateTimeField(auto_now_add=True)
     updated = DateTimeField(auto_now_add=True)
 
@@ -131,8 +162,13 @@ class Order(Model):
     restaurant = ForeignKey(Restaurant, null=True, blank=True, on_delete=models.CASCADE)
     status = CharField(max_length=16, default='unpaid')
     currency = CharField(max_length=16, choices=CURRENCIES, default='cad')
+    total = DecimalField(max_digits=10, decimal_places=3, null=True)
     created = DateTimeField(auto_now_add=True)
-    updated = DateTimeField(auto_now_add=True)
+    updated = DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['restaurant', 'created']), # restaurant order dashboard
+                   models.Index(fields=['restaurant', 'updated'])] # orders feed
 
 
 class OrderItem(Model):
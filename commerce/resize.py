@@ -0,0 +1,124 @@
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from commerce.images import open_upright, to_rgb, JPEG_QUALITY
+
+logger = logging.getLogger(__name__)
+
+MAX_DIMENSION = 2048
+SOURCE_DIRS = ('products/', 'restaurants/') # where Picture.image and Restaurant.image are uploaded
+RESIZE_MAX_AGE = 30 * 24 * 3600 # seconds clients and proxies may keep a variant, the etag revalidates it after
+EVICT_TO = 0.9 # an eviction deletes variants until the cache is back under this part of its size
+
+_size = None # bytes in the cache directory as this process knows it
+_size_lock = threading.Lock()
+
+
+class InvalidResize(Exception):
+    pass
+
+def source_path(path):
+    ''' Absolute path of a resizable image under MEDIA_ROOT, InvalidResize for anything else
+    '''
+    path = os.path.normpath(path).lstrip('/')
+    if not path.startswith(SOURCE_DIRS) or '..' in path.split(os.sep):
+        raise InvalidResize('Not a picture: %s' % path)
+    src = default_storage.path(path)
+    if not os.path.isfile(src):
+        raise InvalidResize('No such picture: %s' % path)
+    return src
+
+def variant_key(src, width, height):
+    # a new or replaced source file gets new variants, the key is also the strong etag
+    st = os.stat(src)
+    s = '%s|%s|%s|%s|%s' % (src, st.st_mtime_ns, st.st_size, width, height)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+def variant_path(key):
+    return os.path.join(settings.RESIZE_CACHE_DIR, key[:2], key + '.jpg')
+
+def resize(src, dest, width, height):
+    # fit the image in width x height, never scaled up
+    from PIL import Image
+    image = open_upright(src)
+    image.thumbnail((width, height), Image.LANCZOS)
+    tmp = '%s.%s.tmp' % (dest, uuid.uuid4().hex)
+    to_rgb(image).save(tmp, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    os.replace(tmp, dest) # readers see the whole file or none
+    return os.path.getsize(dest)
+
+def get_variant(path, width, height):
+    ''' Return (file path, etag) of the image at path (relative to MEDIA_ROOT) fitted in width x height.
+        The variant is made on the first request, requests for the same variant arriving meanwhile,
+        from this process or another one, wait on a lock file and use the one it makes.
+    '''
+    if not (0 < width <= MAX_DIMENSION and 0 < height <= MAX_DIMENSION):
+        raise InvalidResize('Invalid size %sx%s' % (width, height))
+    src = source_path(path)
+    key = variant_key(src, width, height)
+    dest = variant_path(key)
+    if os.path.exists(dest):
+        touch(dest)
+        return dest, key
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(dest + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(dest): # not made while we waited
+                added(resize(src, dest, width, height))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            try:
+                os.remove(dest + '.lock')
+            except OSError:
+                pass
+    return dest, key
+
+def touch(path):
+    # the modification time orders the variants for the eviction, bump it on every hit
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def scan():
+    # [(mtime, size, path)] of the variants in the cache directory
+    files = []
+    for d in os.scandir(settings.RESIZE_CACHE_DIR):
+        if d.is_dir():
+            for f in os.scandir(d.path):
+                if f.name.endswith('.jpg'):
+                    st = f.stat()
+                    files.append((st.st_mtime, st.st_size, f.path))
+    return files
+
+def added(n):
+    ''' Count n new bytes, evict the least recently used variants once the cache is over RESIZE_CACHE_SIZE
+    '''
+    global _size
+    with _size_lock:
+        if _size is None:
+            _size = sum(size for mtime, size, path in scan())
+        else:
+            _size += n
+        if _size <= settings.RESIZE_CACHE_SIZE:
+            return
+        # other processes write here too, start from what is on disk
+        files = sorted(scan())
+        _size = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            if _size <= settings.RESIZE_CACHE_SIZE * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+                _size -= size
+            except OSError as e:
+                logger.error('Evict resized image %s exception:%s' % (path, e))
@@ -0,0 +1,102 @@
+import re
+
+from django.db.models import Sum, Case, When, IntegerField, OuterRef, Subquery
+
+from commerce.models import Product, ProductTerm
+
+SEARCH_LIMIT = 100 # results of a search that isn't paginated
+SEARCH_ORDER = ('-score', 'id') # paginate order of a search result
+MAX_TERM_LENGTH = 32
+
+# weight of a term by the field it comes from
+NAME_WEIGHT = 3
+CATEGORY_WEIGHT = 2
+RESTAURANT_WEIGHT = 1
+
+# runs of CJK ideographs / kana / hangul, or runs of letters and digits of other scripts
+CJK_RE = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+WORD_RE = re.compile(r'[^\W_]+')
+
+
+def tokenize(text):
+    ''' Return the set of search terms of a text.
+        CJK runs such as 土豆排骨 have no spaces, they give their characters and their bigrams
+        (土, 豆, 排, 骨, 土豆, 豆排, 排骨). Other words give the lower cased word and
+        its prefixes of two characters or more, so typing 'pota' finds 'potato'.
+    '''
+    terms = set()
+    if not text:
+        return terms
+    text = text.lower()
+    for run in CJK_RE.findall(text):
+        terms.update(run)
+        terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    for word in WORD_RE.findall(CJK_RE.sub(' ', text)):
+        word = word[:MAX_TERM_LENGTH]
+        terms.update(word[:i] for i in range(2, len(word)))
+        terms.add(word)
+    return terms
+
+def query_terms(keyword):
+    ''' Terms to look up for a keyword, a CJK run of two characters or more is matched by its bigrams
+    '''
+    terms = set()
+    keyword = (keyword or '').lower()
+    for run in CJK_RE.findall(keyword):
+        if len(run) == 1:
+            terms.add(run)
+        else:
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    for word in WORD_RE.findall(CJK_RE.sub(' ', keyword)):
+        terms.add(word[:MAX_TERM_LENGTH])
+    return terms
+
+def index_product(product):
+    ''' Replace the search terms of one product, call it after the product or its categories change
+    '''
+    weights = {}
+    fields = [(product.name, NAME_WEIGHT)]
+    fields += [(c.name, CATEGORY_WEIGHT) for c in product.categories.all()]
+    if product.restaurant_id:
+        fields.append((product.restaurant.name, RESTAURANT_WEIGHT))
+    for text, weight in fields:
+        for term in tokenize(text):
+            weights[term] = weights.get(term, 0) + weight
+
+    ProductTerm.objects.filter(product_id=product.id).delete()
+    ProductTerm.objects.bulk_create([ProductTerm(term=t, product_id=product.id, weight=w)
+                                     for t, w in weights.items()])
+
+def index_restaurant_products(restaurant):
+    ''' Refresh the terms of every product of a restaurant after its name changes
+    '''
+    for product in Product.objects.filter(restaurant_id=restaurant.id).select_related('restaurant'):
+        index_product(product)
+
+def index_category_products(category):
+    ''' Refresh the terms of every product of a category after its name changes
+    '''
+    for product in Product.objects.filter(categories__id=category.id).select_related('restaurant'):
+        index_product(product)
+
+def search_products(keyword, q=None):
+    ''' Return the QuerySet of the products matching a keyword, best first, annotated with their score.
+        The score of a product is the sum of the weights of its terms found in the keyword.
+        q --- optional filter of the products (categories, restaurants), applied before the ranking
+    '''
+    terms = query_terms(keyword)
+    if not terms:
+        return Product.objects.none()
+    matches = ProductTerm.objects.filter(term__in=terms)
+    score = matches.filter(product_id=OuterRef('id')).values('product_id').annotate(s=Sum('weight')).values('s')
+    qs = Product.objects.filter(id__in=matches.values('product_id'))
+    if q:
+        qs = qs.filter(id__in=Product.objects.filter(q).values('id'))
+    return qs.annotate(score=Subquery(score, output_field=IntegerField())).order_by(*SEARCH_ORDER)
+
+def order_by_ids(qs, ids):
+    ''' Order a QuerySet the way ids (a search result) is ordered
+    '''
+    if not ids:
+        return qs
+    return qs.order_by(Case(*[When(id=pid, then=i) for i, pid in enumerate(ids)], output_field=IntegerField()))
@@ -0,0 +1,88 @@
+import glob
+import hashlib
+import os
+import re
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+
+from utils import write_upload
+
+BLOB_RE = re.compile(r'(^|/)[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(_\w+)?\.\w+$')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600 # a blob name never gets other content, it can be cached for good
+
+
+def is_blob(name):
+    return bool(name and BLOB_RE.search(name))
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    ''' Files named by the sha256 of their content under the directory of their upload_to,
+        directory/ab/cd/abcd...ef.jpg, so uploading the same file twice stores it once.
+        Each save adds a reference to the blob and each delete takes one back, the file is only
+        removed with its last reference. Files derived from a blob, name_small.jpg, name.webp...,
+        are removed with it.
+    '''
+    def blob_name(self, directory, digest, ext):
+        return os.path.join(directory, digest[:2], digest[2:4], digest + ext.lower())
+
+    def _save(self, name, content):
+        # write to a temporary file while hashing, then keep it only if the blob is new
+        directory = os.path.dirname(name)
+        tmp = self.path(os.path.join(directory, '.%s.tmp' % uuid.uuid4().hex))
+        sha = hashlib.sha256()
+        write_upload(content, tmp, sha=sha)
+        name = self.blob_name(directory, sha.hexdigest(), os.path.splitext(name)[1])
+        # take the reference first: once add_ref returns, a delete of the last reference running at the
+        # same time has either seen it or finished removing the file, which is then written again
+        self.add_ref(name)
+        if self.exists(name):
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+            os.replace(tmp, self.path(name))
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        return name # the final name is only known once the content is hashed
+
+    def add_ref(self, name):
+        from commerce.models import MediaBlob
+        if MediaBlob.objects.filter(name=name).update(refs=F('refs') + 1):
+            return
+        try:
+            with transaction.atomic():
+                MediaBlob.objects.create(name=name, refs=1)
+        except IntegrityError: # created by another request in between
+            MediaBlob.objects.filter(name=name).update(refs=F('refs') + 1)
+
+    def delete(self, name):
+        ''' Take back a reference, remove the file and its derived files with the last one.
+            Files saved before this storage was used have no reference count, they are removed right away.
+        '''
+        from commerce.models import MediaBlob
+        if not name:
+            return
+        if is_blob(name):
+            with transaction.atomic():
+                blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+                if blob and blob.refs > 1:
+                    MediaBlob.objects.filter(id=blob.id).update(refs=F('refs') - 1)
+                    return
+                if blob:
+                    blob.delete()
+                # still holding the row lock, add_ref of the same blob waits for the files to be gone
+                stem = os.path.splitext(self.path(name))[0]
+                for path in glob.glob(stem + '_*') + glob.glob(stem + '.*'):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+        else:
+            super().delete(name)
+
+media_storage = ContentAddressedStorage()
@@ -1,3 +1,601 @@
-from django.test import TestCase
+import base64
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError
+from django.core.cache import cache
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from commerce import cartstore, images, trending
+from commerce.feed import orders_since, SAFETY_WINDOW
+from commerce.search import index_product, SEARCH_LIMIT
+from commerce.models import Cart, CartItem, Category, FavoriteProduct, MediaBlob, Order, OrderItem, Picture, \
+    Product, ProductTrend, Restaurant
+from commerce.storage import is_blob, media_storage
+from utils import create_jwt_token, write_upload, UploadTooLarge
+
+
+class ProductListQueryCountTest(TestCase):
+    def create_products(self, n):
+        restaurant = Restaurant.objects.create(name='r', lat=43.65, lng=-79.38)
+        category = Category.objects.create(name='c')
+        for i in range(n):
+            product = Product.objects.create(name='p%s'%i, price=12, restaurant=restaurant)
+            product.categories.add(category)
+            for j in range(2):
+                Picture.objects.create(product=product, index=j, name='', image='products/%s_%s.jpg'%(i, j))
+
+    def test_constant_queries(self):
+        # products, their categories and their pictures, whatever the number of products
+        self.create_products(3)
+        with self.assertNumQueries(3):
+            r = self.client.get('/api/products')
+        self.assertEqual(len(r.json()['data']), 3)
+
+        self.create_products(20)
+        with self.assertNumQueries(3):
+            r = self.client.get('/api/products')
+        data = r.json()['data']
+        self.assertEqual(len(data), 23)
+        self.assertEqual([p['index'] for p in data[0]['pictures']], [0, 1])
+        self.assertEqual(data[0]['pictures'][0]['product'], {'id': data[0]['id']})
+
+    def test_constant_queries_paginated(self):
+        self.create_products(30)
+        with self.assertNumQueries(3):
+            r = self.client.get('/api/products?limit=5')
+        self.assertEqual(len(r.json()['data']), 5)
+        with self.assertNumQueries(3):
+            r = self.client.get('/api/products?limit=25')
+        self.assertEqual(len(r.json()['data']), 25)
+
+
+@mock.patch('commerce.cartstore.start_flusher') # the tests flush by hand
+class CartStoreTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        cartstore._dirty.clear()
+        self.buyer = get_user_model().objects.create(username='buyer', email='buyer@example.com')
+        self.products = [Product.objects.create(name='p%s'%i, price=12) for i in range(2)]
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart__user_id=self.buyer.id).values_list('product_id', 'quantity'))
+
+    def other_process(self):
+        # the state of another worker: its own dirty set, the same cache and database
+        return mock.patch.object(cartstore, '_dirty', set())
+
+    def test_add_without_queries(self, start_flusher):
+        p0, p1 = self.products
+        self.assertEqual(cartstore.add_product(self.buyer.id, p0.id), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(cartstore.add_product(self.buyer.id, p0.id), 2)
+            self.assertEqual(cartstore.add_product(self.buyer.id, p1.id), 3)
+            self.assertEqual(cartstore.count_products(self.buyer.id), 3)
+        self.assertEqual(self.quantities(), {})
+
+        cartstore.flush_dirty()
+        self.assertEqual(self.quantities(), {p0.id: 2, p1.id: 1})
+        self.assertEqual(cartstore._dirty, set())
+        cartstore.flush_cart(self.buyer.id) # written once
+        self.assertEqual(self.quantities(), {p0.id: 2, p1.id: 1})
+
+    def test_read_from_other_process(self, start_flusher):
+        p0, p1 = self.products
+        cartstore.add_product(self.buyer.id, p0.id)
+        with self.other_process():
+            cartstore.add_product(self.buyer.id, p1.id)
+            cartstore.add_product(self.buyer.id, p1.id)
+        # the first process is killed before its flush round, the cart is read by another one
+        cartstore._dirty.clear()
+        with self.other_process():
+            r = self.client.get('/api/carts?buyer_id=%s' % self.buyer.id)
+        self.assertEqual(r.json()['nProducts'], 3)
+        self.assertEqual(sorted((i['product']['id'], i['quantity']) for i in r.json()['items']), [(p0.id, 1), (p1.id, 2)])
+
+    def test_remove_keeps_other_adds(self, start_flusher):
+        p0, p1 = self.products
+        cartstore.add_product(self.buyer.id, p1.id)
+        cartstore.flush_dirty()
+        cartstore.add_product(self.buyer.id, p0.id)
+        cartstore.add_product(self.buyer.id, p0.id)
+        with self.other_process():
+            self.assertEqual(cartstore.remove_product(self.buyer.id, p1.id), 2)
+            cartstore.add_product(self.buyer.id, p1.id)
+        self.assertEqual(cartstore.count_products(self.buyer.id), 3)
+        cartstore.flush_dirty() # includes the entry added by the other process
+        self.assertEqual(self.quantities(), {p0.id: 2, p1.id: 1})
+
+    def test_cache_lost(self, start_flusher):
+        # the log goes on from the entries already written
+        p0, p1 = self.products
+        cartstore.add_product(self.buyer.id, p0.id)
+        cartstore.flush_dirty()
+        cache.clear()
+        self.assertEqual(cartstore.add_product(self.buyer.id, p1.id), 2)
+        cartstore.flush_dirty()
+        self.assertEqual(self.quantities(), {p0.id: 1, p1.id: 1})
+
+    def test_missing_entry(self, start_flusher):
+        # entry 1 is taken by a process that dies before writing it
+        p0, p1 = self.products
+        cartstore.next_seq(self.buyer.id)
+        cartstore.add_product(self.buyer.id, p0.id)
+        cartstore.flush_dirty()
+        self.assertEqual(self.quantities(), {})
+        with mock.patch('time.time', return_value=time.time() + cartstore.GAP_TIMEOUT + 1):
+            cartstore.flush_cart(self.buyer.id)
+        self.assertEqual(self.quantities(), {p0.id: 1})
+
+    def test_remove(self, start_flusher):
+        p0, p1 = self.products
+        for p in (p0, p0, p1):
+            cartstore.add_product(self.buyer.id, p.id)
+        self.assertEqual(cartstore.remove_product(self.buyer.id, p0.id), 2)
+        self.assertEqual(self.quantities(), {p0.id: 1, p1.id: 1})
+        self.assertEqual(cartstore.remove_product(self.buyer.id, p1.id), 1)
+        self.assertEqual(self.quantities(), {p0.id: 1})
+        self.assertEqual(cartstore.remove_product(self.buyer.id), 0)
+        self.assertEqual(self.quantities(), {})
+
+    def test_invalid_ids(self, start_flusher):
+        for params in ({'buyer_id': self.buyer.id}, {'buyer_id': self.buyer.id, 'product_id': 'x'}, {'product_id': 1}):
+            r = self.client.post('/api/carts', json.dumps(params), content_type='application/json')
+            self.assertEqual(r.status_code, 400)
+        self.assertEqual(cartstore._dirty, set())
+
+
+class OrderFeedTest(TestCase):
+    def setUp(self):
+        self.restaurant = Restaurant.objects.create(name='r', lat=43.65, lng=-79.38)
+
+    def create_order(self, seconds_ago):
+        order = Order.objects.create(restaurant=self.restaurant)
+        Order.objects.filter(id=order.id).update(updated=timezone.now() - timedelta(seconds=seconds_ago))
+        return order
+
+    def test_late_commit(self):
+        a, b = self.create_order(5), self.create_order(2)
+        orders, watermark = orders_since(self.restaurant.id)
+        self.assertEqual([o.id for o in orders], [a.id, b.id])
+        orders, watermark = orders_since(self.restaurant.id, watermark)
+        self.assertEqual(orders, [])
+
+        # saved before b but committed after the previous poll
+        late = self.create_order(3)
+        orders, watermark = orders_since(self.restaurant.id, watermark)
+        self.assertEqual([o.id for o in orders], [late.id])
+        orders, watermark = orders_since(self.restaurant.id, watermark)
+        self.assertEqual(orders, [])
+
+    def test_pages(self):
+        old = [self.create_order(SAFETY_WINDOW * 2 + i) for i in range(3)]
+        new = [self.create_order(i) for i in range(3, 0, -1)]
+        delivered, watermark = [], None
+        for i in range(4):
+            orders, watermark = orders_since(self.restaurant.id, watermark, limit=2)
+            delivered += [o.id for o in orders]
+        self.assertEqual(delivered, [o.id for o in reversed(old)] + [o.id for o in new])
+
+    def test_token_param(self):
+        # the token is only read from the query string by the event stream
+        user = get_user_model().objects.create(username='admin', email='admin@example.com')
+        token = base64.b64encode(json.dumps(create_jwt_token({'id': user.id, 'username': 'admin'})).encode()).decode()
+        url = '/api/orders/feed?restaurant_id=%s' % self.restaurant.id
+        self.assertEqual(self.client.get(url + '&token=' + token).json(), {'data': [], 'watermark': None})
+        self.assertIsNotNone(self.client.get(url, HTTP_AUTHORIZATION='Bearer ' + token).json()['watermark'])
+        r = self.client.get('/api/orders/events?restaurant_id=%s&token=%s' % (self.restaurant.id, token))
+        self.assertEqual(r['Content-Type'], 'text/event-stream')
+
+
+class SearchPaginationTest(TestCase):
+    def test_pages_keep_ranking(self):
+        # products matching both words rank first, unlike the creation order
+        products = [Product.objects.create(name='spicy tofu' if i % 2 else 'spicy', price=1) for i in range(5)]
+        for product in products:
+            index_product(product)
+        ranked = [p['id'] for p in self.client.get('/api/products?keyword=spicy tofu').json()['data']]
+        self.assertEqual(ranked, [products[i].id for i in (1, 3, 0, 2, 4)])
+
+        ids, cursor = [], None
+        while True:
+            r = self.client.get('/api/products?keyword=spicy tofu&limit=2' + ('&cursor=' + cursor if cursor else '')).json()
+            ids += [p['id'] for p in r['data']]
+            cursor = r['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(ids, ranked)
+
+    def test_filter_before_limit(self):
+        # the matches of a restaurant are found even when other products rank above them
+        restaurants = [Restaurant.objects.create(name='r%s'%i, lat=43.65, lng=-79.38) for i in range(2)]
+        for i in range(SEARCH_LIMIT + 3):
+            index_product(Product.objects.create(name='spicy tofu', price=1, restaurant=restaurants[0]))
+        other = [Product.objects.create(name='spicy', price=1, restaurant=restaurants[1]) for i in range(3)]
+        for product in other:
+            index_product(product)
+        r = self.client.get('/api/products?keyword=spicy tofu&ms=%s' % restaurants[1].id).json()
+        self.assertEqual([p['id'] for p in r['data']], [p.id for p in other])
+
+        # pages go on past SEARCH_LIMIT results
+        n, cursor = 0, ''
+        while True:
+            r = self.client.get('/api/products?keyword=spicy tofu&limit=50' + ('&cursor=' + cursor if cursor else '')).json()
+            n += len(r['data'])
+            cursor = r['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(n, SEARCH_LIMIT + 6)
+
+    def test_category_rename(self):
+        category = Category.objects.create(name='noodles')
+        product = Product.objects.create(name='p', price=1)
+        product.categories.add(category)
+        index_product(product)
+        self.client.post('/api/categories', json.dumps({'id': category.id, 'name': 'ramen'}), content_type='application/json')
+        self.assertEqual([p['id'] for p in self.client.get('/api/products?keyword=ramen').json()['data']], [product.id])
+        self.assertEqual(self.client.get('/api/products?keyword=noodles').json()['data'], [])
+
+
+class InvalidCursorTest(TestCase):
+    def test_bad_request(self):
+        Restaurant.objects.create(name='r', lat=43.65, lng=-79.38)
+        tampered = base64.urlsafe_b64encode(json.dumps(['not a date', 'x']).encode()).decode()
+        for url in ('/api/products', '/api/restaurants', '/api/orders', '/api/restaurants?lat=43.65&lng=-79.38',
+                    '/api/products?keyword=tofu'):
+            sep = '&' if '?' in url else '?'
+            for cursor in ('garbage', tampered):
+                r = self.client.get(url + sep + 'limit=5&cursor=' + cursor)
+                self.assertEqual(r.status_code, 400, url)
+            self.assertEqual(self.client.get(url + sep + 'limit=5').status_code, 200, url)
+
+
+class TrendingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.restaurant = Restaurant.objects.create(name='r', lat=43.65, lng=-79.38)
+        self.products = [Product.objects.create(name='p%s'%i, price=12, restaurant=self.restaurant) for i in range(3)]
+
+    def test_params(self):
+        trending.add_activity([(p.id, self.restaurant.id, i + 1) for i, p in enumerate(self.products)])
+        for k, n in (('0', 1), ('-1', 1), ('2', 2), ('1000', 3)):
+            r = self.client.get('/api/products/trending?k=%s' % k)
+            self.assertEqual(len(r.json()['data']), n)
+        self.assertEqual(r.json()['data'][0]['id'], self.products[2].id)
+        for params in ('k=x', 'restaurant_id=x', 'k=1.5'):
+            self.assertEqual(self.client.get('/api/products/trending?' + params).status_code, 400)
+
+    def test_created_in_between(self):
+        # another request created rows of the batch first, the others are created one by one
+        p0, p1, p2 = self.products
+        trending.add_activity([(p0.id, self.restaurant.id, 1)])
+        with mock.patch.object(ProductTrend.objects, 'bulk_create', side_effect=IntegrityError):
+            trending.add_activity([(p.id, self.restaurant.id, 2) for p in self.products])
+        scores = dict((pid, round(score, 6)) for pid, score in trending.top_products(k=3))
+        self.assertEqual(scores, {p0.id: 3, p1.id: 2, p2.id: 2})
+
+
+def create_products(n, restaurants=(), pictures=0, **fields):
+    # n products spread over the restaurants, each with its pictures
+    products = []
+    for i in range(n):
+        product = Product.objects.create(name='p%s'%i, price=12, restaurant=restaurants[i % len(restaurants)]
+                                         if restaurants else None, **fields)
+        for j in range(pictures):
+            Picture.objects.create(product=product, index=j, name='', image='products/%s_%s.jpg'%(product.id, j))
+        products.append(product)
+    return products
+
+
+class QueryCountMixin:
+    def setUp(self):
+        cache.clear() # carts left by other tests
+        self.user = get_user_model().objects.create(username='buyer', email='buyer@example.com')
+
+    def assertConstantQueries(self, n_queries, request, grow=None, n=10):
+        ''' request(size) costs n_queries for a size of n and for a size of 2n, grow(size) makes the
+            rows of that size first. return the two responses
+        '''
+        responses = []
+        for size in (n, 2 * n):
+            if grow:
+                grow(size)
+            with self.assertNumQueries(n_queries):
+                responses.append(request(size))
+        return responses
+
+
+class PlaceOrdersQueryCountTest(QueryCountMixin, TransactionTestCase):
+    # the orders are committed, so the trending scores and the feed are updated by their on_commit
+    # callbacks inside assertNumQueries, which a TestCase never runs
+    def setUp(self):
+        super().setUp()
+        self.token = base64.b64encode(json.dumps(create_jwt_token({'id': self.user.id, 'username': 'buyer'})).encode()).decode()
+        self.restaurants = [Restaurant.objects.create(name='r%s'%i, lat=43.65, lng=-79.38) for i in range(3)]
+        self.products = create_products(20, self.restaurants)
+
+    def post_orders(self, n_items, n_orders=3):
+        orders = [{'restaurant_id': r.id, 'items': [{'pid': p.id, 'quantity': 2} for p in self.products[:n_items]
+                                                      if p.restaurant_id == r.id]} for r in self.restaurants[:n_orders]]
+        return self.client.post('/api/orders', json.dumps({'orders': orders}), content_type='application/json',
+                                HTTP_AUTHORIZATION='Bearer ' + self.token)
+
+    def test_constant_queries(self):
+        # restaurants, products, the items, then the trending rows locked and updated in one query, each in
+        # its transaction, whatever the number of items and of orders, plus the insert of each order
+        self.post_orders(20) # every product has a trending row, the next calls update them all
+        r, _ = self.assertConstantQueries(7 + 3, self.post_orders)
+        self.assertEqual(r.json(), {'success': True})
+        with self.assertNumQueries(7 + 1):
+            self.post_orders(20, n_orders=1)
+        self.assertEqual(Order.objects.count(), 10)
+        self.assertEqual(OrderItem.objects.count(), 57)
+        self.assertEqual(ProductTrend.objects.count(), 20)
+
+
+class CartQueryCountTest(QueryCountMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.cart = Cart.objects.create(user=self.user)
+
+    def add_items(self, size):
+        for product in create_products(size - self.cart.cartitem_set.count(), pictures=1):
+            CartItem.objects.create(cart=self.cart, product=product, quantity=2)
+
+    def test_constant_queries(self):
+        # the cart, its items with their products, the categories and pictures of the products,
+        # the sum of the quantities
+        get = lambda size: self.client.get('/api/carts?buyer_id=%s' % self.user.id)
+        small, large = self.assertConstantQueries(5, get, self.add_items, n=6)
+        self.assertEqual(small.json()['nProducts'], 12)
+        data = large.json()
+        self.assertEqual((len(data['items']), data['nProducts']), (12, 24))
+        self.assertEqual(len(data['items'][0]['product']['items']), 1)
+
+
+class FavoriteProductQueryCountTest(QueryCountMixin, TestCase):
+    def add_products(self, size):
+        for i, product in enumerate(create_products(size - Product.objects.count(), like_count=1)):
+            if i % 2:
+                FavoriteProduct.objects.create(user=self.user, product=product, status=True)
+
+    def test_constant_queries(self):
+        # the user's likes as a set, the products, their categories
+        url = '/api/favorite-products?user_id=%s' % self.user.id
+        small, large = self.assertConstantQueries(3, lambda size: self.client.get(url), self.add_products)
+        self.assertEqual([p['favorate'] for p in small.json()['favorites']], [False, True] * 5)
+        favorites = large.json()['favorites']
+        self.assertEqual((len(favorites), sum(p['favorate'] for p in favorites)), (20, 10))
+        self.assertEqual(favorites[0]['n_likes'], 1)
+
+        with self.assertNumQueries(3):
+            r = self.client.get(url + '&limit=5')
+        self.assertEqual(len(r.json()['favorites']), 5)
+
+
+def jpeg(color, size=(300, 200), orientation=None):
+    # bytes of a JPEG, with an EXIF orientation tag when given
+    exif = {}
+    if orientation:
+        exif['exif'] = b'Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08\x00\x01' \
+            + b'\x01\x12\x00\x03\x00\x00\x00\x01' + bytes([0, orientation, 0, 0]) + b'\x00\x00\x00\x00'
+    b = io.BytesIO()
+    Image.new('RGB', size, color).save(b, 'JPEG', **exif)
+    return b.getvalue()
+
+
+class MediaRootMixin:
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = self.settings(MEDIA_ROOT=self.media_root)
+        self.media_settings.enable()
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+
+class ImageIngestTest(MediaRootMixin, TransactionTestCase):
+    # the images are finalized by the process pool and recorded by threads of this process
+    def setUp(self):
+        super().setUp()
+        self.product = Product.objects.create(name='p', price=12)
+
+    def ingest(self, data, index=0):
+        pic = Picture(product=self.product, index=index, name='')
+        images.ingest_image(pic, SimpleUploadedFile('a.jpg', data))
+        return pic
+
+    def test_finalize(self):
+        pic = self.ingest(jpeg((200, 10, 10), orientation=6))
+        self.assertTrue(pic.image.name.startswith(images.STAGING_DIR + '/'))
+        self.assertTrue(images.wait_for_images(30))
+        pic.refresh_from_db()
+        self.assertTrue(is_blob(pic.image.name))
+        self.assertEqual((pic.width, pic.height), (200, 300)) # turned upright
+        self.assertTrue(os.path.exists(images.variant_name(pic.image.path, 'small')))
+        self.assertEqual(os.listdir(default_storage.path(images.STAGING_DIR)), [])
+        self.assertEqual(MediaBlob.objects.get().refs, 1)
+
+    def test_same_photo(self):
+        data = jpeg((10, 200, 10))
+        first = self.ingest(data)
+        images.wait_for_images(30)
+        first.refresh_from_db()
+        with mock.patch('commerce.images.get_pool', side_effect=AssertionError('processed again')):
+            second = self.ingest(data, index=1)
+        self.assertEqual((second.image.name, second.width), (first.image.name, first.width))
+        self.assertEqual(MediaBlob.objects.get().refs, 2)
+        self.assertEqual(os.listdir(default_storage.path(images.STAGING_DIR)), [])
+
+    def test_failed(self):
+        # the reference taken for the blob is given back, the picture keeps its staged upload
+        with mock.patch('commerce.images.logger'):
+            pic = self.ingest(b'not an image')
+            self.assertTrue(images.wait_for_images(30))
+        pic.refresh_from_db()
+        self.assertTrue(pic.image.name.startswith(images.STAGING_DIR + '/'))
+        self.assertEqual(MediaBlob.objects.count(), 0)
+
+    def test_replaced_meanwhile(self):
+        pic = Picture.objects.create(product=self.product, index=0, name='', image='products/other.jpg')
+        name = 'products/ab/cd/' + 'abcd' * 16 + '.jpg'
+        media_storage.add_ref(name)
+        future = Future()
+        future.set_result((10, 20))
+        t = threading.Thread(target=images.finish, args=(future, Picture, pic.id, 'image', 'staging/x.jpg', name))
+        t.start()
+        t.join()
+        pic.refresh_from_db()
+        self.assertEqual(pic.image.name, 'products/other.jpg')
+        self.assertEqual(MediaBlob.objects.count(), 0)
+
+
+class BlobStorageTest(MediaRootMixin, TestCase):
+    def save(self, content=b'hello'):
+        return media_storage.save('products/a.txt', ContentFile(content))
+
+    def test_refcount(self):
+        name = self.save()
+        self.assertEqual(self.save(), name)
+        self.assertTrue(is_blob(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).refs, 2)
+        derived = os.path.splitext(media_storage.path(name))[0] + '_small.jpg'
+        open(derived, 'wb').close()
+
+        media_storage.delete(name)
+        self.assertTrue(media_storage.exists(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).refs, 1)
+        media_storage.delete(name)
+        self.assertFalse(media_storage.exists(name))
+        self.assertFalse(os.path.exists(derived))
+        self.assertEqual(MediaBlob.objects.count(), 0)
+
+    def test_save_after_last_delete(self):
+        # the last holder deletes the blob while the same content is saved, before its reference is taken
+        name = self.save()
+        add_ref = media_storage.add_ref
+        def racing(name):
+            media_storage.delete(name)
+            add_ref(name)
+        with mock.patch.object(media_storage, 'add_ref', side_effect=racing):
+            self.assertEqual(self.save(), name)
+        self.assertTrue(media_storage.exists(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).refs, 1)
+
+    def test_delete_during_save(self):
+        # the last holder deletes the blob once the reference of the save is taken
+        name = self.save()
+        add_ref = media_storage.add_ref
+        def racing(name):
+            add_ref(name)
+            media_storage.delete(name)
+        with mock.patch.object(media_storage, 'add_ref', side_effect=racing):
+            self.save()
+        self.assertTrue(media_storage.exists(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).refs, 1)
+
+    def test_reuse_removed_meanwhile(self):
+        # the blob of a photo seen before goes with its last reference while an upload reuses it
+        data = jpeg((10, 10, 200))
+        pic = Picture(product=Product.objects.create(name='p', price=12), index=0, name='')
+        name = images.get_blob_name(pic, 'image', hashlib.sha256(data).hexdigest())
+        os.makedirs(os.path.dirname(media_storage.path(name)))
+        open(media_storage.path(name), 'wb').close()
+        media_storage.add_ref(name)
+        add_ref = media_storage.add_ref
+        def racing(name):
+            media_storage.delete(name)
+            add_ref(name)
+        with mock.patch.object(media_storage, 'add_ref', side_effect=racing):
+            self.assertFalse(images.use_blob(pic, 'image', hashlib.sha256(data).hexdigest()))
+        self.assertEqual(MediaBlob.objects.count(), 0)
+        self.assertIsNone(pic.id)
+
+
+class UploadLimitTest(MediaRootMixin, TestCase):
+    def test_request(self):
+        params = {'name': 'r', 'lat': '43.65', 'lng': '-79.38', 'image_status': 'changed',
+                  'image': SimpleUploadedFile('a.jpg', b'x' * 2000)}
+        with self.settings(MAX_UPLOAD_SIZE=1000):
+            r = self.client.post('/api/restaurants', params)
+        self.assertEqual(r.status_code, 413)
+        self.assertEqual(Restaurant.objects.count(), 0)
+
+    def test_write_upload(self):
+        path = os.path.join(self.media_root, 'up', 'a.bin')
+        self.assertEqual(write_upload(ContentFile(b'x' * 1000), path, max_size=1000), 1000)
+        with self.assertRaises(UploadTooLarge): # known size, nothing is written
+            write_upload(ContentFile(b'y' * 1001), path, max_size=1000)
+        unsized = File(io.BytesIO(b'y' * 3000), name='a.bin')
+        unsized.size = None
+        with self.assertRaises(UploadTooLarge): # found while writing, the temporary file is removed
+            write_upload(unsized, path, max_size=1000)
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['a.bin'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 1000)
+
+
+class MediaServeTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.media_root, 'products'))
+        with open(os.path.join(self.media_root, 'products', 'a.txt'), 'wb') as f:
+            f.write(b'0123456789')
+
+    def get(self, **headers):
+        r = self.client.get('/media/products/a.txt', **headers)
+        content = b''.join(r.streaming_content) if r.streaming else r.content
+        r.close()
+        return r, content
+
+    def test_conditional(self):
+        r, content = self.get()
+        self.assertEqual((r.status_code, content, r['Accept-Ranges']), (200, b'0123456789', 'bytes'))
+        r2, content = self.get(HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual((r2.status_code, content), (304, b''))
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"')[0].status_code, 200)
+        self.assertEqual(self.client.get('/media/products/.a.txt.tmp').status_code, 404)
+
+    def test_range(self):
+        r, content = self.get(HTTP_RANGE='bytes=2-5')
+        self.assertEqual((r.status_code, content, r['Content-Range']), (206, b'2345', 'bytes 2-5/10'))
+        r, content = self.get(HTTP_RANGE='bytes=-3')
+        self.assertEqual((r.status_code, content), (206, b'789'))
+        r, content = self.get(HTTP_RANGE='bytes=20-30')
+        self.assertEqual((r.status_code, r['Content-Range']), (416, 'bytes */10'))
+
+        etag = self.get()[0]['ETag']
+        r, content = self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=etag)
+        self.assertEqual((r.status_code, content), (206, b'2345'))
+        r, content = self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"changed"') # the whole new file
+        self.assertEqual((r.status_code, content), (200, b'0123456789'))
+
+    def test_sendfile(self):
+        path = os.path.join(self.media_root, 'products', 'a.txt')
+        with self.settings(MEDIA_SENDFILE='nginx', MEDIA_SENDFILE_LOCATIONS={self.media_root: '/_media/'}):
+            r, content = self.get()
+        self.assertEqual((r.status_code, r['X-Accel-Redirect'], content), (200, '/_media/products/a.txt', b''))
+        with self.settings(MEDIA_SENDFILE='apache'):
+            r, content = self.get()
+        self.assertEqual((r['X-Sendfile'], content), (path, b''))
+        with self.settings(MEDIA_SENDFILE='nginx', MEDIA_SENDFILE_LOCATIONS={self.media_root: '/_media/'}):
+            r, content = self.get(HTTP_IF_NONE_MATCH=r['ETag']) # answered without the web server
+        self.assertEqual(r.status_code, 304)
+        self.assertFalse(r.has_header('X-Accel-Redirect'))
@@ -0,0 +1,163 @@
+import logging
+import math
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+from django.db.models import Case, When, Value, FloatField, IntegerField
+from django.utils import timezone
+
+from commerce.models import FavoriteProduct, OrderItem, ProductTrend
+
+logger = logging.getLogger(__name__)
+
+# The score of a product is the sum of the weights of its likes and ordered items, each one halved
+# every HALF_LIFE seconds since it happened. Instead of decaying every score as time passes, an
+# activity at time t is stored as weight * 2 ** ((t - EPOCH) / HALF_LIFE), so the order of the stored
+# scores is the order of the decayed scores at any time. Those values double every half life and would
+# overflow a float within years, ProductTrend.score holds their log2 instead, which grows by one per
+# half life: log2(sum of weight * 2 ** exponent(t)).
+HALF_LIFE = 3 * 24 * 3600 # seconds
+EPOCH = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+LIKE_WEIGHT = 1
+ORDER_WEIGHT = 3 # per unit ordered
+
+MIN_SCORE = 0.01 # products below it are not trending, it also hides rounding left by taken back likes
+TOP_K = 10
+MAX_TOP_K = 100
+TOP_TIMEOUT = 60 # seconds a top-k list stays cached
+
+
+def exponent(when=None):
+    ''' log2 of the factor an activity happening at time when is stored with
+    '''
+    when = when or timezone.now()
+    return (when - EPOCH).total_seconds() / HALF_LIFE
+
+def log_add(stored, weight, e):
+    ''' log2(2 ** stored + weight * 2 ** e) computed without overflow, stored None for an empty score.
+        return None when the sum is not positive, every activity taken back
+    '''
+    if stored is None:
+        return e + math.log2(weight) if weight > 0 else None
+    m = max(stored, e)
+    total = 2 ** (stored - m) + weight * 2 ** (e - m)
+    return m + math.log2(total) if total > 1e-9 else None
+
+def current_score(stored, now=None):
+    ''' Decayed score of a product at time now from its stored score
+    '''
+    return 2 ** (stored - exponent(now))
+
+@transaction.atomic
+def add_activity(items, when=None):
+    ''' Add activities to the scores, with a constant number of queries whatever the number of products.
+        The rows of the products are locked while their new scores are computed.
+        items --- [(product_id, restaurant_id, weight)], a negative weight takes a like back,
+                  pass the time of the like as when so the same amount is removed
+    '''
+    e = exponent(when)
+    weights = {}
+    restaurants = {}
+    for pid, rid, weight in items:
+        weights[pid] = weights.get(pid, 0) + weight
+        restaurants[pid] = rid
+    if not weights:
+        return
+
+    trends = ProductTrend.objects.select_for_update().filter(product_id__in=list(weights))
+    stored = dict(trends.values_list('product_id', 'score'))
+    missing = [pid for pid in weights if pid not in stored and log_add(None, weights[pid], e) is not None]
+    new_trend = lambda pid: ProductTrend(product_id=pid, restaurant_id=restaurants[pid], score=log_add(None, weights[pid], e))
+    if missing:
+        try:
+            with transaction.atomic():
+                ProductTrend.objects.bulk_create([new_trend(pid) for pid in missing])
+        except IntegrityError: # another request created some of them in between, create the others one by one
+            created = set()
+            for pid in missing:
+                try:
+                    with transaction.atomic():
+                        new_trend(pid).save()
+                    created.add(pid)
+                except IntegrityError:
+                    pass # created by the other request, added to with the stored ones
+            stored = dict((pid, score) for pid, score in trends.values_list('product_id', 'score') if pid not in created)
+    scores = dict((pid, log_add(score, weights[pid], e)) for pid, score in stored.items())
+    gone = [pid for pid, score in scores.items() if score is None]
+    if gone:
+        ProductTrend.objects.filter(product_id__in=gone).delete()
+    scores = dict((pid, score) for pid, score in scores.items() if score is not None)
+    if scores: # one UPDATE for all of them
+        ProductTrend.objects.filter(product_id__in=list(scores)).update(
+            score=Case(*[When(product_id=pid, then=Value(scores[pid])) for pid in scores], output_field=FloatField()),
+            restaurant_id=Case(*[When(product_id=pid, then=Value(restaurants[pid])) for pid in scores],
+                               output_field=IntegerField()))
+
+def record_activity(items, when=None):
+    ''' add_activity once the current transaction commits. A failure is logged, it never rolls back
+        the order or the like it comes from.
+    '''
+    def run():
+        try:
+            add_activity(items, when)
+        except Exception as e:
+            logger.error('Add trending activity exception:%s' % e)
+    transaction.on_commit(run)
+
+def top_products(restaurant_id=None, k=TOP_K):
+    ''' Return [(product_id, score)] of the k products trending now, globally or in a restaurant,
+        read from ProductTrend through its score index and cached for TOP_TIMEOUT seconds.
+    '''
+    k = max(1, min(k, MAX_TOP_K))
+    key = 'trending:%s:%s' % (restaurant_id or '', k)
+    rs = cache.get(key)
+    if rs is None:
+        e = exponent()
+        trends = ProductTrend.objects.filter(score__gt=math.log2(MIN_SCORE) + e)
+        if restaurant_id:
+            trends = trends.filter(restaurant_id=restaurant_id)
+        rs = [(pid, 2 ** (score - e)) for pid, score in trends.order_by('-score').values_list('product_id', 'score')[:k]]
+        cache.set(key, rs, TOP_TIMEOUT)
+    return rs
+
+def rebuild_scores(batch=500):
+    ''' Recompute every score from the likes and the order items, reading the history batch by batch.
+        return the number of products with a score
+    '''
+    scores = {}
+    restaurants = {}
+
+    def add(pid, rid, weight, when):
+        if pid and weight:
+            scores[pid] = log_add(scores.get(pid), weight, exponent(when))
+            restaurants[pid] = rid
+
+    last_id = 0
+    likes = FavoriteProduct.objects.filter(status=True).order_by('id') \
+        .values_list('id', 'product_id', 'product__restaurant_id', 'created')
+    while True:
+        rows = list(likes.filter(id__gt=last_id)[:batch])
+        if not rows:
+            break
+        for _, pid, rid, created in rows:
+            add(pid, rid, LIKE_WEIGHT, created)
+        last_id = rows[-1][0]
+
+    last_id = 0
+    orderItems = OrderItem.objects.order_by('id') \
+        .values_list('id', 'product_id', 'product__restaurant_id', 'quantity', 'order__created')
+    while True:
+        rows = list(orderItems.filter(id__gt=last_id)[:batch])
+        if not rows:
+            break
+        for _, pid, rid, quantity, created in rows:
+            add(pid, rid, ORDER_WEIGHT * (quantity or 0), created)
+        last_id = rows[-1][0]
+
+    with transaction.atomic():
+        ProductTrend.objects.all().delete()
+        ProductTrend.objects.bulk_create([ProductTrend(product_id=pid, restaurant_id=restaurants[pid], score=score)
+                                          for pid, score in scores.items() if score is not None], batch_size=batch)
+    return len(scores)
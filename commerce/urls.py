@@ -1,14 +1,22 @@
 from django.conf.urls import url
-from commerce.views import ProductListView, ProductView, CategoryView, RestaurantView, OrderView
+from commerce.carts import CartView
+from commerce.views import ProductListView, ProductView, CategoryView, RestaurantView, OrderView, OrderDashboardView, OrderFeedView, OrderEventsView, ProductFilterView, FavoriteProductView, TrendingProductView
 
 urlpatterns = [
     url('restaurants/(?P<id>[0-9]+)', RestaurantView.as_view()),
     url('restaurants', RestaurantView.as_view()),
     url('categories/(?P<id>[0-9]+)', CategoryView.as_view()),
     url('categories', CategoryView.as_view()),
+    url('orders/dashboard', OrderDashboardView.as_view()),
+    url('orders/feed', OrderFeedView.as_view()),
+    url('orders/events', OrderEventsView.as_view()),
     url('orders/(?P<id>[0-9]+)', OrderView.as_view()),
     url('orders', OrderView.as_view()),
+    url('carts', CartView.as_view()),
+    url('favorite-products', FavoriteProductView.as_view()),
+    url('products/trending', TrendingProductView.as_view()),
     url('products', ProductListView.as_view()),
+    url('filters', ProductFilterView.as_view()),
     url('product/(?P<id>[0-9]+)', ProductView.as_view()),
     url('product', ProductView.as_view())
 ]
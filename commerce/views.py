@@ -1,9 +1,14 @@
 import json
 import os
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from django.db import transaction
 from django.db.models import Q,Count
-from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.http import JsonResponse, StreamingHttpResponse, HttpResponseNotFound
+from django.core.serializers.json import DjangoJSONEncoder
 from django.views.generic import View
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
@@ -13,11 +18,131 @@ from django.core.exceptions import ObjectDoesNotExist#EmptyResultSet, MultipleOb
 from django.contrib.auth import get_user_model
 from commerce.models import Restaurant, Picture, Product, Category, Order, OrderItem, Style, PriceRange, FavoriteProduct 
 from account.models import Province, City, Address
+from commerce.geo import find_restaurants_by_location, update_restaurant_index, remove_from_restaurant_index
+from commerce.search import index_product, index_restaurant_products, index_category_products, search_products, \
+    order_by_ids, SEARCH_LIMIT, SEARCH_ORDER
+from commerce.facets import get_facets
+from commerce.feed import orders_since, get_version, wait_for_orders, notify_orders_changed
+from commerce.favorites import liked_product_ids, toggle_favorite
+from commerce.trending import record_activity, top_products, ORDER_WEIGHT, TOP_K
+from commerce.images import ingest_image
+from commerce.resize import get_variant, InvalidResize, RESIZE_MAX_AGE
+from commerce.storage import is_blob, IMMUTABLE_MAX_AGE
+from commerce import cartstore
+from core.media import serve_file
 
-from utils import to_json, obj_to_json, get_data_from_token
+from utils import to_json, obj_to_json, list_to_json, stream_json_response, paginate, get_token_data, verify_token, \
+    InvalidCursor
 
 logger = logging.getLogger(__name__)
 
+def groupPictures(product_ids):
+    # {product_id: [json dicts of its pictures]}, the pictures of all the products are fetched
+    # with one query and grouped in memory
+    groups = {}
+    pics = list(Picture.objects.filter(product_id__in=product_ids).order_by('index', 'id'))
+    for pic, r in zip(pics, list_to_json(pics)):
+        groups.setdefault(pic.product_id, []).append(r)
+    return groups
+
+def addPictures(products, ps):
+    # products --- Product model objects
+    # ps --- their json dicts, the pictures are added as ps[i]['pictures']
+    groups = groupPictures([p['id'] for p in ps])
+    for p in ps:
+        if p['id'] in groups:
+            p['pictures'] = groups[p['id']]
+
+def addOrderItems(orders, rs):
+    # orders --- Order model objects, load them with select_related('user')
+    # rs --- their json dicts, the items and username are added in place
+    # the items of all the orders are fetched with one query and grouped in memory
+    groups = {}
+    items = list(OrderItem.objects.filter(order_id__in=[order.id for order in orders]).order_by('id'))
+    for item, r in zip(items, list_to_json(items)):
+        groups.setdefault(item.order_id, []).append(r)
+
+    for order, ri in zip(orders, rs):
+        ri['items'] = groups.get(order.id, [])
+        if order.user_id:
+            ri['user']['username'] = order.user.username
+
+def parseTime(s, end=False):
+    # s --- '2018-03-01' or '2018-03-01T12:00:00', end=True moves a date to the start of the next day
+    # so that a date range includes its last day
+    t = parse_datetime(s)
+    if t is None:
+        d = parse_date(s)
+        if d is None:
+            raise ValueError('Invalid date %s' % s)
+        t = datetime.combine(d + timedelta(days=1) if end else d, datetime.min.time())
+    if timezone.is_naive(t):
+        t = timezone.make_aware(t)
+    return t
+
+@transaction.atomic
+def placeOrders(uid, orders):
+    # uid --- id of the buyer
+    # orders --- [{'restaurant_id': 2, 'items': [{'pid': 1, 'quantity': 4}, ...]}, ...] from the front end
+    # All the orders are saved or none, prices and totals are taken from the products, not from the front end.
+    restaurants = Restaurant.objects.in_bulk([int(o['restaurant_id']) for o in orders])
+    products = Product.objects.in_bulk([int(item['pid']) for o in orders for item in o['items']])
+
+    saved = []
+    orderItems = []
+    for o in orders:
+        rid = int(o['restaurant_id'])
+        if rid not in restaurants:
+            raise ObjectDoesNotExist('Restaurant %s does not exist' % rid)
+        order = Order(restaurant_id=rid, user_id=uid, total=0)
+        items = []
+        for item in o['items']:
+            product = products.get(int(item['pid']))
+            quantity = int(item['quantity'])
+            if product is None:
+                raise ObjectDoesNotExist('Product %s does not exist' % item['pid'])
+            if quantity < 1:
+                raise ValueError('Invalid quantity %s' % quantity)
+            items.append(OrderItem(product=product, product_name=product.name,
+                                   price=product.price, quantity=quantity))
+            order.total += (product.price or 0) * quantity
+        order.save()
+        for orderItem in items:
+            orderItem.order = order
+        orderItems += items
+        saved.append(order)
+
+    OrderItem.objects.bulk_create(orderItems)
+    record_activity([(item.product_id, products[item.product_id].restaurant_id, ORDER_WEIGHT * item.quantity)
+                     for item in orderItems])
+    for rid in set(order.restaurant_id for order in saved):
+        transaction.on_commit(lambda rid=rid: notify_orders_changed(rid))
+    return saved
+
+def parseIds(s):
+    # s --- comma separated ids from a query param, values that are not ids are ignored
+    ids = set()
+    for v in (s or '').split(','):
+        v = v.strip()
+        if v.isdigit() and int(v) > 0:
+            ids.add(int(v))
+    return sorted(ids)
+
+def getRestaurantId(req):
+    # restaurant of the business user of the token, the admin user passes restaurant_id
+    data = get_token_data(req)
+    if not data:
+        return None
+    rid = data.get('restaurant_id')
+    if not rid and data.get('username') == 'admin':
+        rid = req.GET.get('restaurant_id')
+    return rid
+
+def ordersToJson(orders):
+    r = to_json(orders)
+    addOrderItems(orders, r)
+    return r
+
 def processPictures(product, pictures):
     # pid --- product id
     # pictures --- dict that pass from the front end
@@ -35,7 +160,6 @@ def processPictures(product, pictures):
                 rmPicture(pic)
             elif picture['status'] == 'changed':
                 savePicture(product, pic, picture)
-                pic.save()
         else:# new
             pic = Picture()
             savePicture(product, pic, picture)
@@ -50,8 +174,7 @@ def savePicture(product, pic, picture):
     pic.index = picture['index']
     pic.name = picture['name']
     pic.product = product
-    pic.image.save(picture['image'].name, picture['image'].file, True)
-    pic.save()
+    ingest_image(pic, picture['image']) # saves pic, the image is finalized in the background
                 
 def getDefaultPicture(pictures):
     if pictures.count() == 0:
@@ -63,11 +186,8 @@ def getDefaultPicture(pictures):
             return ''
 
 def rmPicture(pic):
-    try:
-        os.remove(pic.image.path)
-    except:
-        print('remove image failed')
-    pic.image.delete()
+    # the file is shared by the pictures of the same photo, the storage removes it with the last one
+    pic.image.delete(save=False)
     pic.delete()
 
 def reindexPicture(pid):
@@ -99,6 +219,7 @@ def saveProduct(params):
         
     #item.category = category
     item.save()
+    index_product(item)
 #     item.categories.clear()
     # Assume there is only one image
 #     n_pics = int(params.get('n_pictures'))
@@ -117,25 +238,6 @@ def saveProduct(params):
 #             item.save()
     return item
 
-def find_restaurants_by_location(lat, lng, distance):
-    query = """SELECT *, 
-        (
-           3959 *
-           acos(cos(radians(%s)) * 
-           cos(radians(lat)) * 
-           cos(radians(lng) - 
-           radians(%s)) + 
-           sin(radians(%s)) * 
-           sin(radians(lat )))
-        ) AS distance 
-        FROM commerce_restaurant 
-        HAVING distance < %s 
-        ORDER BY distance LIMIT 0, 20;"""%(lat, lng, lat, distance)
-    try:
-        return Restaurant.objects.raw(query)
-    except:
-        return None
-                
 @method_decorator(csrf_exempt, name='dispatch')
 class RestaurantView(View):
     def getList(self, req):
@@ -143,6 +245,7 @@ class RestaurantView(View):
         lng = req.GET.get('lng')
         distance = 25 # km
         restaurants = []
+        page = {}
         admin_id = req.GET.get('admin_id')
         if admin_id: # need address
             try:
@@ -153,17 +256,20 @@ class RestaurantView(View):
             except Exception:
                 return JsonResponse({'data':[]})
         elif lat and lng: # do not need address
-            restaurants = find_restaurants_by_location(lat, lng, distance)
+            restaurants, next_cursor = find_restaurants_by_location(lat, lng, distance,
+                                                                    req.GET.get('limit'), req.GET.get('cursor'))
+            page = {'next_cursor': next_cursor}
         else:
             try:
                 restaurants = Restaurant.objects.all()#.annotate(n_products=Count('product'))
             except Exception:
                 return JsonResponse({'data':[]})
-        rs =[]
-        for r in restaurants:
-            rs.append(to_json(r))
-        
-        return JsonResponse({'data': rs })
+            restaurants, page = paginate(restaurants, req)
+
+        if req.GET.get('stream') and not page:
+            return stream_json_response(restaurants, related_lookup=True)
+        rs = list_to_json(restaurants, related_lookup=True)
+        return JsonResponse({'data': rs, **page})
     
     def getAddress(self, restaurant):
         addr_id = restaurant.address.id
@@ -193,15 +299,14 @@ class RestaurantView(View):
         if pid:
             instance = Restaurant.objects.get(id=pid)
             instance.delete()
+            remove_from_restaurant_index(pid)
             items = Restaurant.objects.filter().order_by('-updated')
             return JsonResponse({'data':to_json(items)})
         return JsonResponse({'data':[]})
     
     def post(self, req, *args, **kwargs):
         params = req.POST
-        authorizaion = req.META['HTTP_AUTHORIZATION']
-        token = authorizaion.replace("Bearer ", "")
-        data = get_data_from_token(token)
+        data = get_token_data(req)
 #         if data and data['username']=='admin':
         _id = params.get('id')
         if _id:
@@ -224,14 +329,14 @@ class RestaurantView(View):
             self.saveAddress(addr, params)
             item.address = addr
         item.save()
+        index_restaurant_products(item)
     
         image_status = params.get('image_status')
         if image_status == 'changed':
-            self.rmPicture(item)
             image  = req.FILES.get("image")
-            item.image.save(image.name, image.file, True)
-            item.save()
+            ingest_image(item, image) # saves item and releases the previous image, finalized in the background
         
+        update_restaurant_index(item)
         return JsonResponse({'data':to_json(item)})
     
     def saveAddress(self, addr1, params):
@@ -245,10 +350,7 @@ class RestaurantView(View):
         addr1.save()
     
     def rmPicture(self, item):
-        try:
-            os.remove(item.image.path)
-        except:
-            print('remove image failed')
+        # the file is shared by the restaurants of the same photo, the storage removes it with the last one
         item.image.delete()
 
 
@@ -294,10 +396,13 @@ class CategoryView(View):
         else:                    
             item = Category()
             
+        renamed = item.id and item.name != params.get('name')
         item.name = params.get('name')
         item.description = params.get('description')
 #         item.status = params.get('status')
         item.save()
+        if renamed:
+            index_category_products(item)
         return JsonResponse({'data':to_json(item)})
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -329,37 +434,30 @@ class ProductListView(View):
             
         restaurant_id = req.GET.get('restaurant_id')
         category_id = req.GET.get('category_id')
+        ranked = False # search result, best first
           
         if restaurant_id:
-            products = Product.objects.filter(restaurant_id=restaurant_id).annotate(n_likes=Count('favoriteproduct'))
+            products = Product.objects.filter(restaurant_id=restaurant_id)
         elif category_id:
-            products = Product.objects.filter(category_id=category_id).annotate(n_likes=Count('favoriteproduct'))
+            products = Product.objects.filter(category_id=category_id)
+        elif keyword:
+            products = search_products(keyword, q)
+            ranked = True
         elif cats or restaurants or colors:
-            if keyword:
-                products = Product.objects.filter(q).filter(Q(name__icontains=keyword)
-                                                  |Q(categories__name__icontains=keyword)
-                                                  |Q(restaurant__name__icontains=keyword)
-                                                  |Q(color__name__icontains=keyword))
-            else:
-                products = Product.objects.filter(q)
+            products = Product.objects.filter(q)
         else:
-            if keyword:
-                products = Product.objects.filter(Q(name__icontains=keyword)
-                                                  |Q(categories__name__icontains=keyword)
-                                                  |Q(restaurant__name__icontains=keyword)
-                                                  |Q(color__name__icontains=keyword))
-            else:
-                products = Product.objects.filter().annotate(n_likes=Count('favoriteproduct'))
-                
+            products = Product.objects.filter()
+
+        if ranked: # pages of the search keep its ranking
+            products, page = paginate(products, req, order=SEARCH_ORDER)
+            if not page:
+                products = products[:SEARCH_LIMIT]
+        else:
+            products, page = paginate(products, req)
+        if req.GET.get('stream') and not page:
+            return stream_json_response(products, extend=addPictures)
         ps = to_json(products)
-        for p in ps:
-            try:
-                pics = Picture.objects.filter(product_id=p['id'])
-            except:
-                pics = None
-                 
-            if pics:
-                p['pictures'] = to_json(pics)
+        addPictures(products, ps)
 
         #s = []
 #         for product in products:
@@ -377,12 +475,10 @@ class ProductListView(View):
 #             p['like'] = fp.status if fp else False
 
 #             s.append(p)
-        return JsonResponse({'data':ps})
+        return JsonResponse({'data':ps, **page})
 
     def post(self, req, *args, **kwargs):
-        authorizaion = req.META['HTTP_AUTHORIZATION']
-        token = authorizaion.replace("Bearer ", "")
-        data = get_data_from_token(token)
+        data = get_token_data(req)
         
         for key in req.POST:
             params = json.loads(req.POST[key])
@@ -407,11 +503,51 @@ class ProductListView(View):
 @method_decorator(csrf_exempt, name='dispatch')
 class ProductFilterView(View):
     def get(self, req, *args, **kwargs):
-        categories = Category.objects.all();
-        styles = Style.objects.all();
-        price_ranges = PriceRange.objects.all();
-        return JsonResponse({'categories':categories, 'styles':styles, 'price_ranges':price_ranges})
+        ''' categories, styles and price ranges with their number of products,
+            optionally for one restaurant or for the current cats/ms filter of the product list
+        '''
+        restaurant_ids = parseIds(req.GET.get('restaurant_id'))
+        facets = get_facets(restaurant_ids[0] if restaurant_ids else None,
+                            parseIds(req.GET.get('cats')), parseIds(req.GET.get('ms')))
+        return JsonResponse(facets)
     
+@method_decorator(csrf_exempt, name='dispatch')
+class TrendingProductView(View):
+    def get(self, req, *args, **kwargs):
+        ''' products trending now, globally or in the restaurant of restaurant_id, best first
+            k --- number of products, 10 by default, at most 100
+        '''
+        try:
+            restaurant_id = int(req.GET['restaurant_id']) if req.GET.get('restaurant_id') else None
+            k = int(req.GET.get('k', TOP_K))
+        except ValueError:
+            return JsonResponse({'errors':['Invalid restaurant_id or k']}, status=400)
+        trends = top_products(restaurant_id, k)
+        ids = [pid for pid, score in trends]
+        products = order_by_ids(Product.objects.filter(id__in=ids), ids)
+        ps = to_json(products)
+        addPictures(products, ps)
+        scores = dict(trends)
+        for p in ps:
+            p['score'] = scores[p['id']]
+        return JsonResponse({'data':ps})
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ImageResizeView(View):
+    def get(self, req, *args, **kwargs):
+        ''' /media/resize/<w>x<h>/<path>, the picture at path under MEDIA_ROOT fitted in w x h as a JPEG
+        '''
+        try:
+            fpath, key = get_variant(kwargs.get('path'), int(kwargs.get('w')), int(kwargs.get('h')))
+        except InvalidResize as e:
+            return HttpResponseNotFound(str(e))
+
+        if is_blob(kwargs.get('path')): # the content of a blob never changes, nor its variants
+            cache_control = 'public, max-age=%s, immutable' % IMMUTABLE_MAX_AGE
+        else:
+            cache_control = 'public, max-age=%s' % RESIZE_MAX_AGE
+        return serve_file(req, fpath, content_type='image/jpeg', etag='"%s"' % key, cache_control=cache_control)
+
 @method_decorator(csrf_exempt, name='dispatch')
 class ProductView(View):
     def get(self, req, *args, **kwargs):
@@ -427,10 +563,8 @@ class ProductView(View):
             return JsonResponse({'product':''})
 
         product = products[0]
-        pics = Picture.objects.filter(product_id=product.id)
-        ps = []
-        for pic in pics:
-            ps.append(to_json(pic))
+        pics = Picture.objects.filter(product_id=product.id).order_by('index', 'id')
+        ps = list_to_json(pics, related_lookup=True)
  
         p = to_json(product)
         p['pictures'] = ps
@@ -447,10 +581,8 @@ class ProductView(View):
     
     def post(self, req, *args, **kwargs):
         params = req.POST
-        authorizaion = req.META['HTTP_AUTHORIZATION']
-        token = authorizaion.replace("Bearer ", "")
-        data = get_data_from_token(token)
-        if data and data['username']=='admin' or data['utype']=='business':
+        data = get_token_data(req)
+        if data and (data.get('username')=='admin' or data.get('utype')=='business'):
             item = saveProduct(params)
             item.categories.clear()
             
@@ -461,6 +593,7 @@ class ProductView(View):
                 except:
                     category = None
                 item.categories.add(category)
+            index_product(item)
             
             n_pics = int(params.get('n_pictures'))
             pictures = []
@@ -483,24 +616,26 @@ class ProductView(View):
             
 @method_decorator(csrf_exempt, name='dispatch')
 class OrderView(View):
-    def getList(self, rid=None):
+    def getList(self, req, rid=None):
         orders = []
+        page = {}
         try:
             if rid:
-                orders = Order.objects.filter(restaurant_id=rid).order_by('created')
+                orders = Order.objects.filter(restaurant_id=rid).select_related('user').order_by('created')
             else:
-                orders = Order.objects.all().order_by('created')#.annotate(n_products=Count('product'))
+                orders = Order.objects.all().select_related('user').order_by('created')#.annotate(n_products=Count('product'))
             
+            orders, page = paginate(orders, req)
+            if req.GET.get('stream') and not page:
+                return stream_json_response(orders, extend=addOrderItems)
             r = to_json(orders)
-            for order in orders:
-                items = OrderItem.objects.filter(order_id=order.id)
-                ri = next((x for x in r if x['id'] == order.id), None)
-                ri['items'] = to_json(items)
-                ri['user']['username'] = order.user.username                    
+            addOrderItems(orders, r)
+        except InvalidCursor:
+            raise
         except Exception as e:
             logger.error('Get Order Exception:%s'%e)
             return JsonResponse({'data':[]})
-        return JsonResponse({'data': r})
+        return JsonResponse({'data': r, **page})
 
     def get(self, req, *args, **kwargs):
         cid = kwargs.get('id')
@@ -513,12 +648,10 @@ class OrderView(View):
                 return JsonResponse({'data':''})
         else:
             rid = req.GET.get('restaurant_id')
-            return self.getList(rid)
+            return self.getList(req, rid)
         
     def post(self, req, *args, **kwargs):
-        authorizaion = req.META['HTTP_AUTHORIZATION']
-        token = authorizaion.replace("Bearer ", "")
-        data = get_data_from_token(token)
+        data = get_token_data(req)
         if data:
             uid = data['id']
             ubody = req.body.decode('utf-8')
@@ -526,65 +659,128 @@ class OrderView(View):
             # dict: {'orders': [{'restaurant_id': 2, 'items': [{'pid': 1, 'name': '土豆排骨', 'price': '12.000', 'restaurant_id': 
             #2, 'quantity': 4}, {'pid': 2, 'name': '泡椒豆腐', 'price': '12.000', 'restaurant_id': 2, 'quantity': 2}]}], 
             #'user_id': 7}
-            orders = d.get("orders")
-            for data in orders:
-                rid = data['restaurant_id']
-                items = data['items']
-                order = Order()
-                try:
-                    restaurant = Restaurant.objects.get(id=rid)
-                    user = get_user_model().objects.get(id=uid)
-                    order.restaurant = restaurant
-                    order.user = user
-                    order.save()
-                except Exception as e:
-                    print(e)
-                
-                if order.id:
-                    for item in items:
-                        orderItem = OrderItem()
-                        orderItem.order = order
-                        orderItem.product = Product.objects.get(id=item['pid'])
-                        orderItem.quantity = item['quantity']
-                        orderItem.product_name = orderItem.product.name
-                        orderItem.price = orderItem.product.price
-                        orderItem.save()
-                return JsonResponse({'success': True})
+            try:
+                cartstore.flush_cart(uid) # checkout, the cart is persisted before the orders
+                placeOrders(uid, d.get("orders"))
+            except Exception as e:
+                logger.error('Place order exception:%s'%e)
+                return JsonResponse({'success':False})
+            return JsonResponse({'success': True})
         return JsonResponse({'success':False})
     
+@method_decorator(csrf_exempt, name='dispatch')
+class OrderDashboardView(View):
+    def get(self, req, *args, **kwargs):
+        ''' Orders of the restaurant of the logged in business user, with their items and usernames.
+            Optional params: from, to (dates or datetimes, both included), status (comma separated),
+            cursor and limit. The admin user passes restaurant_id.
+            The cost is two queries (orders with users, items) whatever the number of orders.
+        '''
+        rid = getRestaurantId(req)
+        if not rid:
+            return JsonResponse({'data':[]})
+
+        orders = Order.objects.filter(restaurant_id=rid).select_related('user')
+        try:
+            if req.GET.get('from'):
+                orders = orders.filter(created__gte=parseTime(req.GET.get('from')))
+            if req.GET.get('to'):
+                orders = orders.filter(created__lt=parseTime(req.GET.get('to'), end=True))
+        except ValueError as e:
+            logger.error('Order dashboard exception:%s'%e)
+            return JsonResponse({'data':[]})
+        status = req.GET.get('status')
+        if status:
+            orders = orders.filter(status__in=status.split(','))
+
+        orders, page = paginate(orders.order_by('created', 'id'), req)
+        return JsonResponse({'data': ordersToJson(orders), **page})
+
+FEED_LIMIT = 100
+MAX_WAIT = 30 # seconds a long poll is held
+EVENTS_DURATION = 300 # seconds an event stream stays open, EventSource then reconnects with Last-Event-ID
+EVENTS_HEARTBEAT = 15
+
+@method_decorator(csrf_exempt, name='dispatch')
+class OrderFeedView(View):
+    def get(self, req, *args, **kwargs):
+        ''' Orders of the restaurant created or updated after the since watermark, with the watermark
+            to send next time. Without since the whole history is returned, FEED_LIMIT orders at a time.
+            With wait=<seconds> the request is held until an order arrives (long poll).
+        '''
+        rid = getRestaurantId(req)
+        if not rid:
+            return JsonResponse({'data':[], 'watermark':None})
+        since = req.GET.get('since')
+        try:
+            wait = min(max(float(req.GET.get('wait') or 0), 0), MAX_WAIT)
+        except ValueError:
+            wait = 0
+
+        deadline = time.time() + wait
+        version = get_version(rid)
+        orders, watermark = orders_since(rid, since, FEED_LIMIT)
+        while not orders and time.time() < deadline:
+            current = wait_for_orders(rid, version, deadline - time.time())
+            if current == version:
+                break
+            version = current
+            orders, watermark = orders_since(rid, since, FEED_LIMIT)
+        return JsonResponse({'data': ordersToJson(orders), 'watermark': watermark})
+
+@method_decorator(csrf_exempt, name='dispatch')
+class OrderEventsView(View):
+    def get(self, req, *args, **kwargs):
+        ''' Server-Sent Events stream of the orders of the restaurant, each event carries the orders
+            created or updated since the previous one and the watermark as its id.
+            EventSource cannot set headers, the token may come as the token param here, and only here.
+        '''
+        if not get_token_data(req) and req.GET.get('token'):
+            req.token_data = verify_token(req.GET.get('token'))
+        rid = getRestaurantId(req)
+        if not rid:
+            return JsonResponse({'data':[]})
+        since = req.META.get('HTTP_LAST_EVENT_ID') or req.GET.get('since')
+        response = StreamingHttpResponse(self.events(rid, since), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no' # nginx must not buffer the stream
+        return response
+
+    def events(self, rid, watermark):
+        deadline = time.time() + EVENTS_DURATION
+        while time.time() < deadline:
+            version = get_version(rid)
+            orders, watermark = orders_since(rid, watermark, FEED_LIMIT)
+            if orders:
+                data = json.dumps(ordersToJson(orders), cls=DjangoJSONEncoder)
+                yield 'id: %s\ndata: %s\n\n' % (watermark, data)
+            elif wait_for_orders(rid, version, min(EVENTS_HEARTBEAT, deadline - time.time())) == version:
+                yield ': keepalive\n\n'
+
 @method_decorator(csrf_exempt, name='dispatch')
 class FavoriteProductView(View):
     def get(self, req, *args, **kwargs):
+        # the like counts are stored on the products and the user's likes are read once as a set,
+        # the number of queries doesn't depend on the number of products
         uid = req.GET.get('user_id')
-        ps = Product.objects.annotate(n_likes=Count('favoriteproduct'))
-        favorites = []
-        for p in ps:
-            product = p.to_json()
-            product['n_likes'] = p.n_likes
-            fp = None
-            try:
-                fp = FavoriteProduct.objects.get(user_id=uid)
-            except:
-                pass
-                
-            product['favorate'] = fp.status if fp else False
-            favorites.append(product)
-            
-        return JsonResponse({'favorites':favorites})
-    
+        liked = liked_product_ids(uid)
+        products, page = paginate(Product.objects.all(), req)
+        favorites = to_json(products)
+        for product in favorites:
+            product['n_likes'] = product['like_count']
+            product['favorate'] = product['id'] in liked
+
+        return JsonResponse({'favorites':favorites, **page})
+
     def post(self, req, *args, **kwargs):
+        ''' Toggle the like of a user on a product
+        '''
         ubody = req.body.decode('utf-8')
         d = json.loads(ubody)
         uid = d.get("user_id")
         pid = d.get("product_id")
         try:
-            like = FavoriteProduct.objects.get(user_id=uid, product_id=pid)
-            like.delete()
-        except ObjectDoesNotExist: 
-            like = FavoriteProduct()
-            like.product = Product.objects.get(id=pid)
-            like.user = get_user_model().objects.get(id=uid)
-            like.status = True
-            like.save()   
-        return JsonResponse({'success':'true'})    
-        
+            liked, n = toggle_favorite(uid, pid)
+        except ObjectDoesNotExist:
+            return JsonResponse({'success':'false'})
+        return JsonResponse({'success':'true', 'favorate':liked, 'n_likes':n})
@@ -0,0 +1,156 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, HttpResponse, HttpResponseNotFound
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.generic import View
+
+from commerce.storage import is_blob, IMMUTABLE_MAX_AGE
+
+MEDIA_MAX_AGE = 3600 # seconds a file that may be replaced under the same name is cached, the etag revalidates it after
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileRange:
+    ''' The bytes [start, start + length) of an open file. read() stops at the end of the range and the
+        file is positioned at start, so a wsgi.file_wrapper using sendfile (gunicorn) sends the range
+        from the file descriptor, bounded by Content-Length.
+    '''
+    def __init__(self, f, start, length):
+        self.f = f
+        self.remaining = length
+        f.seek(start)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+def file_etag(st):
+    # strong, like nginx: changes with any new content written to the path
+    return '"%x-%x-%x"' % (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def parse_range(header, size):
+    ''' (start, length) of a single byte range header, None to send the whole file (no header, several
+        ranges or a syntax error), ValueError when the range is out of the file
+    '''
+    m = RANGE_RE.match(header.strip()) if header else None
+    if not m or m.group(1) == m.group(2) == '':
+        return None
+    if m.group(1) == '': # the last n bytes
+        n = int(m.group(2))
+        if n == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - n, 0), min(n, size)
+    start = int(m.group(1))
+    end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end - start + 1
+
+def range_is_current(req, etag, mtime):
+    # If-Range: the range only applies to the representation the client already has part of
+    if_range = req.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    date = parse_http_date_safe(if_range)
+    return date is not None and int(mtime) <= date
+
+def sendfile_header(fpath):
+    ''' (header, value) handing fpath to the web server, None when MEDIA_SENDFILE is off or fpath is in
+        no directory of MEDIA_SENDFILE_LOCATIONS
+    '''
+    backend = getattr(settings, 'MEDIA_SENDFILE', None)
+    if backend == 'apache': # mod_xsendfile, XSendFilePath must allow the directory
+        return 'X-Sendfile', fpath
+    if backend == 'nginx':
+        for root, location in getattr(settings, 'MEDIA_SENDFILE_LOCATIONS', {}).items():
+            root = os.path.join(os.path.abspath(root), '')
+            if fpath.startswith(root):
+                return 'X-Accel-Redirect', location.rstrip('/') + '/' + quote(fpath[len(root):])
+    return None
+
+def serve_file(req, fpath, content_type=None, etag=None, cache_control=None):
+    ''' Respond with the file at the absolute path fpath.
+        Conditional requests are answered from os.stat alone (304 / 412). The body is then left to the
+        web server when MEDIA_SENDFILE is set, which also handles Range. Otherwise it is a FileResponse,
+        sent with os.sendfile by servers whose wsgi.file_wrapper supports it, and a single byte Range
+        gets a 206 with only that part.
+        etag --- strong etag of the content, made from the file's inode, mtime and size by default
+    '''
+    try:
+        f = open(fpath, 'rb')
+        st = os.fstat(f.fileno())
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return HttpResponseNotFound()
+
+    etag = etag or file_etag(st)
+    headers = {'ETag': etag, 'Last-Modified': http_date(st.st_mtime), 'Accept-Ranges': 'bytes'}
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    if not content_type:
+        content_type, encoding = mimetypes.guess_type(fpath)
+
+    response = get_conditional_response(req, etag=etag, last_modified=int(st.st_mtime))
+    offload = None if response else sendfile_header(fpath)
+    if response or offload:
+        f.close()
+        if offload:
+            response = HttpResponse(content_type=content_type or 'application/octet-stream')
+            response[offload[0]] = offload[1]
+    else:
+        try:
+            part = parse_range(req.META.get('HTTP_RANGE'), st.st_size) if range_is_current(req, etag, st.st_mtime) else None
+        except ValueError:
+            f.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % st.st_size
+            return response
+        if part:
+            start, length = part
+            response = FileResponse(FileRange(f, start, length), status=206,
+                                    content_type=content_type or 'application/octet-stream')
+            response['Content-Range'] = 'bytes %s-%s/%s' % (start, start + length - 1, st.st_size)
+            response['Content-Length'] = length
+        else:
+            response = FileResponse(f, content_type=content_type or 'application/octet-stream')
+            response['Content-Length'] = st.st_size
+
+    for k, v in headers.items():
+        response[k] = v
+    return response
+
+class MediaView(View):
+    def get(self, req, *args, **kwargs):
+        ''' /media/<path>, the file at path under MEDIA_ROOT. Replaces django.views.static.serve, which
+            only runs in DEBUG and reads the files in Python.
+        '''
+        path = kwargs.get('path', '')
+        if any(p.startswith('.') for p in path.split('/')): # hidden and temporary files of the uploads
+            return HttpResponseNotFound()
+        try:
+            fpath = safe_join(settings.MEDIA_ROOT, path)
+        except SuspiciousFileOperation:
+            return HttpResponseNotFound()
+
+        if is_blob(path): # the content of a blob never changes
+            cache_control = 'public, max-age=%s, immutable' % IMMUTABLE_MAX_AGE
+        else:
+            cache_control = 'public, max-age=%s' % MEDIA_MAX_AGE
+        return serve_file(req, fpath, cache_control=cache_control)
@@ -0,0 +1,43 @@
+from django.http import JsonResponse
+
+from utils import get_token_data, UploadTooLarge, InvalidCursor
+
+
+class JWTAuthenticationMiddleware:
+    ''' Verify the jwt of the request once, the views read the result as req.token_data
+        or with utils.get_token_data(req).
+    '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, req):
+        get_token_data(req)
+        return self.get_response(req)
+
+
+class UploadLimitMiddleware:
+    ''' Answer 413 when an uploaded file is over MAX_UPLOAD_SIZE, see utils.SizeLimitUploadHandler
+    '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, req):
+        return self.get_response(req)
+
+    def process_exception(self, req, exception):
+        if isinstance(exception, UploadTooLarge):
+            return JsonResponse({'errors':[str(exception)]}, status=413)
+
+
+class InvalidCursorMiddleware:
+    ''' Answer 400 when the cursor of a paginated list can't be decoded, see utils.paginate
+    '''
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, req):
+        return self.get_response(req)
+
+    def process_exception(self, req, exception):
+        if isinstance(exception, InvalidCursor):
+            return JsonResponse({'errors':[str(exception)]}, status=400)
@@ -50,6 +50,9 @@ else:
 
 ADMIN_ENABLED = True
 
+# keep restaurant coordinates in an in-process NumPy index for the location search
+GEO_INDEX_ENABLED = cfg.get('GEO_INDEX_ENABLED', False)
+
 if cfg['ENV'] == 'production':
     ALLOWED_HOSTS = ['127.0.0.1', APP_DOMAIN]
     if APP_DOMAIN_ALIAS:
@@ -82,6 +85,9 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.JWTAuthenticationMiddleware',
+    'core.middleware.UploadLimitMiddleware',
+    'core.middleware.InvalidCursorMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -126,6 +132,17 @@ DATABASES = {
 }
 
 
+# Set "CACHES" in the config (memcached, file based ...) to share the cache between worker processes
+CACHES = cfg.get('CACHES', {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+})
+# cache holding the carts until they are written to the database, see commerce.cartstore. It must be
+# shared by the processes and must not evict entries (eg. redis with maxmemory-policy noeviction)
+CART_CACHE = cfg.get('CART_CACHE', 'default')
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -191,6 +208,27 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static/')
 # user-uploaded files.
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
+# variants made by /media/resize/<w>x<h>/<path>, the least recently used are deleted past RESIZE_CACHE_SIZE bytes
+RESIZE_CACHE_DIR = cfg.get('RESIZE_CACHE_DIR', os.path.join(BASE_DIR, 'cache/resize/'))
+RESIZE_CACHE_SIZE = cfg.get('RESIZE_CACHE_SIZE', 512 * 1024 * 1024)
+
+# hand the body of media files to the web server instead of sending it from Django, see core.media:
+# 'nginx' (X-Accel-Redirect) or 'apache' (X-Sendfile), None to send files with a FileResponse
+MEDIA_SENDFILE = cfg.get('MEDIA_SENDFILE', None)
+# nginx internal location of each served directory, eg. location /_media/ { internal; alias <MEDIA_ROOT>; }
+MEDIA_SENDFILE_LOCATIONS = cfg.get('MEDIA_SENDFILE_LOCATIONS', {
+    MEDIA_ROOT: '/_media/',
+    RESIZE_CACHE_DIR: '/_resize/',
+})
+
+# bytes, a bigger uploaded file is refused while the request is read, see utils.write_upload
+MAX_UPLOAD_SIZE = cfg.get('MAX_UPLOAD_SIZE', 20 * 1024 * 1024)
+FILE_UPLOAD_HANDLERS = [
+    'utils.SizeLimitUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
 # CORS_ORIGIN_ALLOW_ALL = True
 
 ADMIN_PORT = str(cfg['ADMIN_PORT'])
@@ -17,11 +17,15 @@ from django.conf.urls import url
 from django.urls import include, path
 from django.contrib import admin
 from account.views import LoginView
+from commerce.views import ImageResizeView
+from core.media import MediaView
 
 urlpatterns = [
     path('api/', include('account.urls')),
     path('api/', include('commerce.urls')),
     path('api/', include('blog.urls')),
+    url(r'^media/resize/(?P<w>[0-9]+)x(?P<h>[0-9]+)/(?P<path>.+)$', ImageResizeView.as_view()),
+    url(r'^media/(?P<path>.+)$', MediaView.as_view()),
 #   url('api/login', LoginView.as_view())
     #url(r'^api/login', LoginView.as_view()),
     # url(r'^api/users', UserView.as_view()),
@@ -49,15 +53,6 @@ urlpatterns = [
 
 
 from django.conf import settings
-from django.views.static import serve
-
-if settings.DEBUG:
-    urlpatterns += [
-        url(r'^media/(?P<path>.*)$', serve, {
-            'document_root': settings.MEDIA_ROOT,
-        }),
-        # url(r'^users', AccountView.as_view())
-    ]
 
 if settings.ADMIN_ENABLED:
     urlpatterns +=  [
@@ -1,66 +1,261 @@
+import os
 import jwt
+import json
+import time
+import uuid
+import logging
 import base64
+import hashlib
+import threading
 
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from itertools import islice
 from django.conf import settings
-from django.db.models.query import QuerySet
+from django.core.exceptions import ValidationError, FieldDoesNotExist
+from django.core.files.uploadhandler import FileUploadHandler
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.db.models import Q
+from django.db.models.query import QuerySet, prefetch_related_objects
 from django.db.models.fields.related import ForeignKey, ManyToManyField
 from django.db.models.fields.files import ImageField
-from django.db.models.fields.reverse_related import ManyToOneRel
 
+logger = logging.getLogger(__name__)
+
+
+# field kinds used by the serialization plans
+FIELD_VALUE = 0
+FIELD_IMAGE = 1
+FIELD_FK = 2
+FIELD_M2M = 3
+FIELD_REVERSE = 4
+
+_json_plans = {}
+
+def get_json_plan(model):
+    ''' Build the list of (name, attname, kind) obj_to_json walks for a model class.
+        The plan is computed once per class and cached, so serializing a row no
+        longer calls _meta.get_fields() or the isinstance chain.
+    '''
+    plan = _json_plans.get(model)
+    if plan is None:
+        plan = []
+        for field in model._meta.get_fields():
+            if isinstance(field, ManyToManyField):
+                kind = FIELD_M2M
+            elif isinstance(field, ForeignKey):
+                kind = FIELD_FK
+            elif isinstance(field, ImageField):
+                kind = FIELD_IMAGE
+            elif field.auto_created and not field.concrete:
+                # reverse relation, only reachable when its accessor has the field name (one to one)
+                if not hasattr(model, field.name):
+                    continue
+                kind = FIELD_REVERSE
+            else:
+                kind = FIELD_VALUE
+            plan.append((field.name, getattr(field, 'attname', field.name), kind))
+        _json_plans[model] = plan
+    return plan
+
+def prefetch_for_json(items, related_lookup=False):
+    ''' Batch-load the many to many, reverse one to one and (with related_lookup) foreign key
+        data obj_to_json will read, with one query per relation instead of one per row.
+        items --- list of instances of the same model
+    '''
+    if not items:
+        return
+    plan = get_json_plan(type(items[0]))
+    lookups = [name for name, attname, kind in plan
+               if kind in (FIELD_M2M, FIELD_REVERSE) or (related_lookup and kind == FIELD_FK)]
+    if not lookups:
+        return
+    prefetch_related_objects(items, *lookups)
+    for name, attname, kind in plan:
+        if kind == FIELD_M2M:
+            prefetch_for_json([r for d in items for r in getattr(d, name).all()])
+        elif kind == FIELD_FK and related_lookup:
+            prefetch_for_json([r for r in (getattr(d, name) for d in items) if r is not None])
 
 def obj_to_json(d, related_lookup=False):
     ''' d --- django Model class instance
     '''
     item = {}
     if d and d._meta:
-        fields = d._meta.get_fields()
-        for field in fields:
-            field_name = field.name
-            #print(type(field))
-            if hasattr(d, field_name):
+        for field_name, attname, kind in get_json_plan(type(d)):
+            if kind == FIELD_VALUE:
+                item[field_name] = getattr(d, field_name)
+            elif kind == FIELD_FK:
+                if related_lookup:
+                    item[field_name] = obj_to_json(getattr(d, field_name))
+                else:
+                    v = getattr(d, attname)
+                    if v:
+                        item[field_name] = {'id': v }
+            elif kind == FIELD_IMAGE:
                 v = getattr(d, field_name)
-                if isinstance(field, ManyToOneRel) or field_name=='password': 
-                    pass
-                if isinstance(field, ManyToManyField):
-                    item[field_name] = to_json(v.all())
-                elif isinstance(field, ForeignKey):
-                    if related_lookup:
-                        item[field_name] = obj_to_json(v)
-                    else:
-                        if v and v.id:
-                            item[field_name] = {'id': v.id }
-                elif isinstance(field, ImageField):
-                    #item[key] = v.name if v else None
-                    if v and v.name:
-                        item[field_name] = { 'data':v.name, 'file':'' }
-                    else:
-                        item[field_name] = { 'data':'', 'file':'' }
+                if v and v.name:
+                    item[field_name] = { 'data':v.name, 'file':'' }
                 else:
-                    item[field_name] = v
-    #     # version 1
-    #     for k in d.__dict__.keys():
-    #         if not '__' in k and not k.startswith('_'):
-    #             v = getattr(d, k)
-    #             if isinstance(v, ImageFieldFile):
-    #                 item[k] = getattr(d, k).name if getattr(d, k) else None
-    #             else: 
-    #                 item[k] = getattr(d, k)
+                    item[field_name] = { 'data':'', 'file':'' }
+            elif kind == FIELD_M2M:
+                item[field_name] = to_json(getattr(d, field_name).all())
+            elif hasattr(d, field_name): # reverse one to one
+                item[field_name] = getattr(d, field_name)
     return item
 
+def is_flat_model(model):
+    ''' True if every field obj_to_json emits for the model is a plain column value
+    '''
+    return all(kind == FIELD_VALUE for name, attname, kind in get_json_plan(model))
+
+def values_to_json(qs):
+    ''' Serialize a QuerySet of a flat model (Category, Style, PriceRange, Address ...) straight
+        from values(), skipping model instance construction. Same output as list_to_json.
+    '''
+    return list(qs.values(*[name for name, attname, kind in get_json_plan(qs.model)]))
+
+def list_to_json(a, related_lookup=False):
+    ''' Serialize a QuerySet or list of instances of one model, prefetching related data in batch
+    '''
+    items = list(a)
+    prefetch_for_json(items, related_lookup)
+    return [obj_to_json(d, related_lookup) for d in items]
+
 def to_json(a):
-    if isinstance(a, QuerySet) and a.exists() or isinstance(a, list):
-        r = []
-        for d in a:
-            item = obj_to_json(d, related_lookup=False)
-            r.append(item)
-        return r
-    elif isinstance(a, QuerySet) and a.count()==0:
-        return []
+    ''' a --- QuerySet, list of model instances or a single instance.
+        A QuerySet is evaluated exactly once, no exists() or count() round trip first.
+    '''
+    if isinstance(a, QuerySet):
+        if a._result_cache is None and is_flat_model(a.model):
+            return values_to_json(a)
+        return list_to_json(a)
+    elif isinstance(a, list):
+        return list_to_json(a)
     else:
         return obj_to_json(a, related_lookup=True)
 
 
+STREAM_CHUNK_SIZE = 500
+
+def iter_json_chunks(a, related_lookup=False, chunk_size=STREAM_CHUNK_SIZE):
+    ''' Yield (instances, json dicts) chunk by chunk, reading a QuerySet with iterator(chunk_size)
+        so only one chunk of rows is held in memory at a time.
+    '''
+    it = a.iterator(chunk_size=chunk_size) if isinstance(a, QuerySet) else iter(a)
+    while True:
+        items = list(islice(it, chunk_size))
+        if not items:
+            return
+        prefetch_for_json(items, related_lookup)
+        yield items, [obj_to_json(d, related_lookup) for d in items]
+
+def stream_json_response(a, related_lookup=False, extend=None, chunk_size=STREAM_CHUNK_SIZE):
+    ''' Return a StreamingHttpResponse with the same {"data": [...]} body JsonResponse would send.
+        extend --- optional function(items, rs) called on each chunk to add data to the dicts
+    '''
+    def content():
+        yield '{"data": ['
+        sep = ''
+        for items, rs in iter_json_chunks(a, related_lookup, chunk_size):
+            if extend:
+                extend(items, rs)
+            yield sep + ', '.join(json.dumps(r, cls=DjangoJSONEncoder) for r in rs)
+            sep = ', '
+        yield ']}'
+    return StreamingHttpResponse(content(), content_type='application/json')
+
+
+PAGE_LIMIT = 20
+MAX_PAGE_LIMIT = 200
+
+class InvalidCursor(Exception):
+    pass
+
+def encode_cursor(values):
+    ''' values --- ordering values of the last row of a page, returns an opaque url safe string
+    '''
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('utf-8')
+
+def load_cursor(cursor, n):
+    ''' Return the list of n raw values stored in the cursor, None if the cursor is not valid
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != n:
+        return None
+    return values
+
+def to_python(model, name, value):
+    # value of a field from json, an annotation (eg. the score of a search) is a number
+    try:
+        return model._meta.get_field(name).to_python(value)
+    except FieldDoesNotExist:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValidationError('Invalid value of %s' % name)
+        return value
+
+def decode_cursor(cursor, model, order):
+    ''' Return the ordering values stored in the cursor, None if the cursor is not valid
+    '''
+    values = load_cursor(cursor, len(order))
+    if values is None:
+        return None
+    try:
+        return [to_python(model, f.lstrip('-'), v) for f, v in zip(order, values)]
+    except ValidationError:
+        return None
+
+def keyset_after(order, values):
+    ''' Q of the rows coming after the row with these ordering values
+    '''
+    names = [f.lstrip('-') for f in order]
+    q = Q()
+    for i, name in enumerate(names):
+        lookup = 'lt' if order[i].startswith('-') else 'gt'
+        cond = Q(**{'%s__%s' % (name, lookup): values[i]})
+        for j in range(i):
+            cond &= Q(**{names[j]: values[j]})
+        q |= cond
+    return q
+
+def paginate(qs, req, order=('created', 'id')):
+    ''' Keyset pagination driven by the 'cursor' and 'limit' GET params, it never uses OFFSET so
+        any page costs the same as the first one.
+        order --- ordering fields or annotations, ascending or descending ('-score', 'id'), ending with a unique field
+        return (rows, page) where rows is the qs untouched and page {} when neither param is given,
+        otherwise rows is a list of at most limit instances and page is {'next_cursor': ...}
+        InvalidCursor for a cursor that can't be decoded, InvalidCursorMiddleware answers 400
+    '''
+    cursor = req.GET.get('cursor')
+    limit = req.GET.get('limit')
+    if not cursor and not limit:
+        return qs, {}
+
+    try:
+        limit = min(max(int(limit), 1), MAX_PAGE_LIMIT)
+    except (TypeError, ValueError):
+        limit = PAGE_LIMIT
+
+    qs = qs.order_by(*order)
+    if cursor:
+        values = decode_cursor(cursor, qs.model, order)
+        if values is None: # not the first page again, a client following it would loop
+            raise InvalidCursor('Invalid cursor: %s' % cursor)
+        qs = qs.filter(keyset_after(order, values))
+
+    rows = list(qs[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, f.lstrip('-')) for f in order])
+    return rows, {'next_cursor': next_cursor}
+
 def create_jwt_token(obj):
     payload = {
         'data': obj,
@@ -75,12 +270,145 @@ def decode_jwt_token(token):
     except:
         return None
 
+
+TOKEN_CACHE_SIZE = 10000 # verified tokens kept, least recently used first out
+TOKEN_CACHE_TTL = 3600 # seconds a token without expiry stays verified
+
+_verified_tokens = OrderedDict() # sha256 of the token -> (data, expires timestamp)
+_verified_tokens_lock = threading.Lock()
+
+def get_token_expiry(payload):
+    # the expiry claim is str(datetime.utcnow() + ...), see create_jwt_token
+    s = payload.get('expiry')
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return (datetime.strptime(s, fmt) - datetime(1970, 1, 1)).total_seconds()
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def verify_token(token):
+    ''' token --- value of the Authorization header without 'Bearer ', the base64 of the quoted jwt
+        return the data of a valid token that has not expired, None otherwise.
+        Verified tokens are kept in a bounded LRU keyed by their digest until their expiry,
+        so a client sending the same token again skips the base64 decoding and the signature check.
+    '''
+    if not token:
+        return None
+    key = hashlib.sha256(token.encode('utf-8')).digest()
+    now = time.time()
+    with _verified_tokens_lock:
+        entry = _verified_tokens.get(key)
+        if entry:
+            if entry[1] > now:
+                _verified_tokens.move_to_end(key)
+                return dict(entry[0])
+            del _verified_tokens[key]
+
+    try:
+        s = base64.b64decode(token).decode("utf-8").replace('"', '')
+    except (ValueError, UnicodeDecodeError):
+        return None
+    payload = decode_jwt_token(s)
+    if not payload or not payload.get('data'):
+        return None
+    expires = get_token_expiry(payload) or now + TOKEN_CACHE_TTL
+    if expires <= now:
+        return None
+
+    with _verified_tokens_lock:
+        _verified_tokens[key] = (payload['data'], expires)
+        while len(_verified_tokens) > TOKEN_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
+    return dict(payload['data'])
+
 def get_data_from_token(token):
     # reading from http header
-    if token:
-        s = base64.b64decode(token).decode("utf-8").replace('"', '')
-        payload = decode_jwt_token(s)
-        if payload and payload['data']:
-            return payload['data']
-    return None        
+    return verify_token(token)
+
+def get_token_data(req):
+    ''' Data of the token in the Authorization header of a request. It is verified once per request by
+        JWTAuthenticationMiddleware and kept as req.token_data, None when there is no valid token.
+        The token is never read from the query string, where it would end up in access logs,
+        see OrderEventsView for the one exception.
+    '''
+    if not hasattr(req, 'token_data'):
+        authorizaion = req.META.get('HTTP_AUTHORIZATION', '')
+        req.token_data = verify_token(authorizaion.replace("Bearer ", ""))
+    return req.token_data
+
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+upload_stats = {'files': 0, 'bytes': 0, 'seconds': 0.0} # totals of write_upload in this process
+_upload_stats_lock = threading.Lock()
+
+class UploadTooLarge(Exception):
+    pass
+
+class SizeLimitUploadHandler(FileUploadHandler):
+    ''' First of FILE_UPLOAD_HANDLERS, stop reading a file of the request body as soon as it goes over
+        MAX_UPLOAD_SIZE, before the next handlers keep it in memory or in a temporary file.
+        UploadLimitMiddleware answers 413.
+    '''
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.MAX_UPLOAD_SIZE:
+            raise UploadTooLarge('%s is over %s bytes' % (self.file_name, settings.MAX_UPLOAD_SIZE))
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+def write_upload(upload, path, max_size=None, sha=None):
+    ''' Write an uploaded file (or any django File) to path chunk by chunk, so only one chunk is in memory.
+        The chunks go to a temporary file next to path that is fsynced then renamed, path holds
+        the whole upload or is left as it was.
+        max_size --- bytes, MAX_UPLOAD_SIZE by default, UploadTooLarge when the upload is bigger
+        sha --- hashlib object updated with the content
+        return the number of bytes written
+    '''
+    max_size = max_size or settings.MAX_UPLOAD_SIZE
+    if upload.size is not None and upload.size > max_size:
+        raise UploadTooLarge('%s is over %s bytes' % (upload.name, max_size))
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    start = time.time()
+    n = 0
+    try:
+        with open(tmp, 'wb') as f:
+            if hasattr(upload, 'seek'):
+                upload.seek(0)
+            for chunk in upload.chunks(UPLOAD_CHUNK_SIZE):
+                n += len(chunk)
+                if n > max_size: # size unknown or wrong
+                    raise UploadTooLarge('%s is over %s bytes' % (upload.name, max_size))
+                if sha:
+                    sha.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    fd = os.open(directory, os.O_RDONLY) # make the rename itself durable
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
+    seconds = time.time() - start
+    with _upload_stats_lock:
+        upload_stats['files'] += 1
+        upload_stats['bytes'] += n
+        upload_stats['seconds'] += seconds
+    logger.info('Wrote upload %s: %d bytes in %.3fs, %.0f bytes/s' % (path, n, seconds, n / seconds if seconds else 0))
+    return n